@@ -0,0 +1,5 @@
+"""
+Helpers shared by the conversation, attribute and recommendation packages
+
+Kept free of imports from those packages so any of them can depend on it.
+"""
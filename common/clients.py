@@ -0,0 +1,37 @@
+"""
+Process-wide OpenAI clients with pooled HTTP connections
+"""
+import functools
+import os
+import httpx
+import openai
+
+# Shared by every caller, so sized for concurrent sessions
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+@functools.lru_cache(maxsize=1)
+def get_openai() -> openai.OpenAI:
+    """Shared synchronous client for code running in worker threads"""
+    return openai.OpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        http_client=openai.DefaultHttpxClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS)
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_async_openai() -> openai.AsyncOpenAI:
+    """
+    Shared async client; concurrent sessions reuse warm keep-alive connections
+    (multiplexed over HTTP/2 when h2 is installed)
+    """
+    return openai.AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        http_client=openai.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS)
+    )
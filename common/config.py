@@ -0,0 +1,12 @@
+"""
+Application configuration (data/config.json), parsed once per path
+"""
+import functools
+from typing import Any, Dict
+from . import serialization
+
+
+@functools.lru_cache(maxsize=4)
+def load_config(config_file: str = "data/config.json") -> Dict[str, Any]:
+    """Load a configuration file once per path; the returned dict is shared, do not modify it"""
+    return serialization.load_file(config_file)
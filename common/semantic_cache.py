@@ -0,0 +1,74 @@
+"""
+Embedding-indexed cache for reusing LLM results across near-duplicate inputs
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Bucketed nearest-neighbour cache over normalized embeddings.
+
+    Entries are grouped by an exact bucket key (e.g. a conversation state
+    signature); within a bucket the cached value with the highest cosine
+    similarity to the query embedding is returned if it clears the threshold.
+    Entries older than ttl_seconds (if set) are never returned. Safe to share
+    between threads.
+    """
+
+    def __init__(self, threshold: float = 0.92, max_entries_per_bucket: int = 256,
+                 ttl_seconds: Optional[float] = None):
+        self.threshold = threshold
+        self.max_entries_per_bucket = max_entries_per_bucket
+        self.ttl_seconds = ttl_seconds
+        self._buckets: Dict[str, Tuple[np.ndarray, List[Any], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(embedding: Sequence[float]) -> np.ndarray:
+        """Convert an embedding to a unit-length float32 vector"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, bucket: str, embedding: np.ndarray) -> Optional[Any]:
+        """Return the most similar cached value in the bucket, if similar enough"""
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is None:
+                return None
+
+            matrix, values, added_at = entry
+            scores = matrix @ embedding
+            if self.ttl_seconds is not None:
+                expired = np.asarray(added_at) < time.time() - self.ttl_seconds
+                scores = np.where(expired, -np.inf, scores)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return values[best]
+            return None
+
+    def add(self, bucket: str, embedding: np.ndarray, value: Any):
+        """Insert a value, evicting the oldest entry when the bucket is full"""
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is None:
+                self._buckets[bucket] = (embedding[np.newaxis, :], [value], [time.time()])
+                return
+
+            matrix, values, added_at = entry
+            matrix = np.vstack([matrix, embedding])
+            values.append(value)
+            added_at.append(time.time())
+            if len(values) > self.max_entries_per_bucket:
+                matrix = matrix[1:]
+                values.pop(0)
+                added_at.pop(0)
+            self._buckets[bucket] = (matrix, values, added_at)
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._buckets.clear()
@@ -0,0 +1,30 @@
+"""
+JSON helpers for the conversation hot path, using orjson when available
+"""
+import json
+from typing import Any, Union
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> str:
+    """Serialize to a compact JSON string"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False)
+
+
+def loads(text: Union[str, bytes]) -> Any:
+    """Parse a JSON document"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def load_file(path: str) -> Any:
+    """Parse a JSON file (read as bytes, which both parsers accept)"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
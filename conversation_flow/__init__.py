@@ -5,7 +5,14 @@ This module provides a conversation manager that uses LLM to make all
 conversation decisions through dynamic prompts, avoiding hardcoded logic.
 """
 
-from .conversation_manager import SimplifiedConversationManager, SimpleConversationManager
 from .models import ConversationState, ConversationTurn, ConversationPhase
 
 __all__ = ['SimplifiedConversationManager', 'SimpleConversationManager', 'ConversationState', 'ConversationTurn', 'ConversationPhase']
+
+
+def __getattr__(name):
+    """Import the manager (and with it openai and both engines) only when first requested"""
+    if name in ('SimplifiedConversationManager', 'SimpleConversationManager'):
+        from . import conversation_manager
+        return getattr(conversation_manager, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
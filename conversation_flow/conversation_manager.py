@@ -5,65 +5,88 @@ Uses LLM to make all conversation decisions through dynamic prompts,
 avoiding hardcoded logic and keeping the code minimal and flexible.
 """
 
+import functools
+import hashlib
+import itertools
 import json
 import os
+import re
 import sys
-from typing import Dict, List, Any, Optional
-import openai
-from .models import ConversationState, ConversationTurn, ConversationPhase
+from collections import ChainMap, OrderedDict
+from typing import Callable, Dict, List, Any, Literal, Optional, Tuple
+from pydantic import BaseModel, Field
 
 # Add parent directory to path for vibe mapper import
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from vibe_attribute_engine import VibeToAttributeMapper
+from vibe_attribute_engine.models import AttributeExtractionResult
+from .models import ConversationState, ConversationTurn, ConversationPhase
+from common.semantic_cache import SemanticCache
+from common import serialization
+from common.config import load_config
 
+# Maximum number of LLM decisions kept in the per-manager LRU cache
+DECISION_CACHE_SIZE = 1024
 
-class SimplifiedConversationManager:
-    """
-    LLM-driven conversation manager that uses dynamic prompts to handle
-    all conversation logic without hardcoded rules.
-    
-    Key features:
-    - Single dynamic prompt system
-    - LLM makes all decisions (what to ask, when to proceed, how to respond)
-    - Minimal state tracking
-    - Natural conversational responses
-    - Flexible and easy to modify through prompt updates
-    """
-    
-    def __init__(self, config_file: str = "data/config.json"):
-        """Initialize the simplified conversation manager"""
-        # Load configuration
-        with open(config_file, 'r') as f:
-            self.config = json.load(f)
-        
-        # Initialize OpenAI client
-        self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        
-        # Initialize vibe mapper for attribute extraction
-        self.vibe_mapper = VibeToAttributeMapper(config_file)
-        
-        # Logging callback for detailed logs
-        self.log_callback = None
-        
-        # Single dynamic prompt template
-        self.dynamic_prompt = """You are a friendly personal shopping assistant helping users find perfect fashion items.
+# Phase lookup by value, avoiding the Enum value-map walk on every turn
+_PHASE_BY_VALUE = {phase.value: phase for phase in ConversationPhase}
+
+# Maximum clarifying questions before recommendations (mirrors the prompt's DECISION RULES)
+MAX_QUESTIONS = 2
+
+# Phrasings for questions the decision rules can ask without the LLM, keyed by missing attribute
+QUESTION_TEMPLATES = {
+    'sizes': [
+        "Love it! What size should I look for?",
+        "Great choice! Which size do you usually wear?",
+        "Sounds lovely! What size works best for you?"
+    ],
+    'category': [
+        "Love that vibe! Are you thinking dresses, tops, skirts, or pants?",
+        "Great start! What kind of piece are you after - a dress, top, skirt, or pants?",
+        "Sounds fun! Should I look at dresses, tops, skirts, or pants for you?"
+    ]
+}
+
+
+# ============================================================================
+# PYDANTIC MODELS FOR OPENAI STRUCTURED OUTPUT
+# ============================================================================
+
+class TurnDecision(BaseModel):
+    """Next conversation action chosen by the LLM"""
+    action: Literal["ask_question", "ready_for_recommendations", "handle_changes"]
+    response_message: str = Field(description="Natural, conversational response to the user")
+    next_phase: Literal["gathering_info", "ready_for_recommendations", "handling_changes"]
+    reasoning: str = Field(description="Brief explanation of the decision")
+
+
+class CombinedTurnResult(BaseModel):
+    """Attribute extraction and conversation decision from a single LLM request"""
+    extracted: AttributeExtractionResult
+    decision: TurnDecision
+
+
+# Static system prompt: identical bytes on every call so the provider's
+# prompt cache can reuse the prefix; per-turn context goes in the user message
+SYSTEM_PROMPT = """You are a friendly personal shopping assistant helping users find perfect fashion items.
 
 CONTEXT:
-- Original Query: "{original_query}"
-- Current Attributes: {attributes}
-- Conversation History: {history}
-- User Input: "{user_input}"
-- Questions Asked: {questions_asked}/2
-- Current Phase: {current_phase}
+Each user message is a JSON object describing the current conversation:
+- "original_query": the user's original request
+- "attributes": attributes gathered so far (null if none)
+- "history": the most recent conversation messages (null if none)
+- "user_input": the user's latest message (empty on the first turn)
+- "questions_asked": clarifying questions asked so far, out of a maximum of 2
+- "current_phase": the current conversation phase
 
 TASK: Analyze the conversation and decide the next action. Respond with valid JSON only:
 
-{{
+{
   "action": "ask_question" | "ready_for_recommendations" | "handle_changes",
   "response_message": "Your natural, conversational response",
   "next_phase": "gathering_info" | "ready_for_recommendations" | "handling_changes",
   "reasoning": "Brief explanation of your decision"
-}}
+}
 
 DECISION RULES:
 - STRICT LIMIT: Maximum 2 questions allowed for gathering info
@@ -83,65 +106,429 @@ EXAMPLES:
 - Ready for recs: "Perfect! Based on your need for polished client meeting attire in size L, I've selected pieces that balance professionalism with modern style. These options work beautifully for work occasions and stay within your budget, focusing on versatile pieces that can transition from boardroom to networking events."
 - Handle changes: "I totally get that! Let me find some more formal options for you."
 
-Respond with JSON only:"""
+Respond with JSON only."""
 
-    def build_prompt(self, state: ConversationState, user_input: str = "") -> str:
-        """Build dynamic prompt with current conversation context"""
+
+@functools.lru_cache(maxsize=4)
+def _get_vibe_mapper(config_file: str):
+    """Shared VibeToAttributeMapper per configuration file"""
+    from vibe_attribute_engine import VibeToAttributeMapper
+    return VibeToAttributeMapper(config_file)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_combined_system_prompt(config_file: str) -> str:
+    """Static system prompt for the combined extraction + decision call"""
+    vibe_mapper = _get_vibe_mapper(config_file)
+    return f"""{SYSTEM_PROMPT}
+
+ATTRIBUTE EXTRACTION:
+Also extract fashion attributes, price preferences, and product details from "user_input" into "extracted",
+and put your conversation decision into "decision". Treat attributes you extract as already known when deciding.
+
+{vibe_mapper.llm_extractor.system_prompt}
+
+AVAILABLE ATTRIBUTE VALUES:
+{json.dumps(vibe_mapper.schema.get_all_attributes(), indent=2)}"""
+
+
+@functools.lru_cache(maxsize=4)
+def _get_schema_value_pattern(config_file: str) -> "re.Pattern[str]":
+    """Whole-word match of any schema attribute value (short size codes like "M" case-sensitively)"""
+    schema = _get_vibe_mapper(config_file).schema.get_all_attributes()
+    values = {value for attr_values in schema.values() for value in attr_values if value != 'Other'}
+    words = sorted((re.escape(v) for v in values if len(v) > 2), key=len, reverse=True)
+    codes = sorted((re.escape(v) for v in values if len(v) <= 2), key=len, reverse=True)
+    return re.compile(r"\b(?:(?i:" + "|".join(words) + ")|" + "|".join(codes) + r")\b")
+
+
+class ResponseMessageStreamer:
+    """
+    Incrementally decodes the "response_message" string value from a streamed
+    JSON decision, so the message can be shown before the full object arrives.
+    """
+    
+    KEY = '"response_message"'
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+    
+    def __init__(self):
+        self.buffer = ""
+        self.position = -1  # Index of the next undecoded character of the value
+        self.done = False
+    
+    def _find_value_start(self) -> int:
+        """Locate the opening quote of the value, or -1 if not streamed yet"""
+        key_index = self.buffer.find(self.KEY)
+        if key_index < 0:
+            return -1
+        colon_index = self.buffer.find(':', key_index + len(self.KEY))
+        if colon_index < 0:
+            return -1
+        quote_index = self.buffer.find('"', colon_index + 1)
+        return quote_index + 1 if quote_index >= 0 else -1
+    
+    def feed(self, chunk: str) -> str:
+        """Add a streamed chunk and return newly decoded message text"""
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self.position < 0:
+            self.position = self._find_value_start()
+            if self.position < 0:
+                return ""
+        
+        decoded = []
+        i = self.position
+        buffer = self.buffer
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                i += 1
+                continue
+            # Escape sequence: wait for the rest of it if it is split across chunks
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape == 'u':
+                if i + 6 > len(buffer):
+                    break
+                code = int(buffer[i + 2:i + 6], 16)
+                if 0xD800 <= code < 0xDC00:
+                    # High surrogate: decode together with the following low surrogate
+                    if i + 12 > len(buffer):
+                        break
+                    low = int(buffer[i + 8:i + 12], 16)
+                    decoded.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                else:
+                    decoded.append(chr(code))
+                    i += 6
+            else:
+                decoded.append(self.ESCAPES.get(escape, escape))
+                i += 2
+        
+        self.position = i
+        return "".join(decoded)
+
+
+def _render_context(original_query: str, attributes: str, history: str, user_input: str,
+                    questions_asked: int, current_phase: str) -> str:
+    """
+    Render the per-turn context message from pre-encoded JSON values.
+    
+    The skeleton is compiled once as an f-string; slot values are encoded compactly
+    (orjson when available) rather than re-indenting the whole tree.
+    """
+    return f"""{{
+  "original_query": {original_query},
+  "attributes": {attributes},
+  "history": {history},
+  "user_input": {user_input},
+  "questions_asked": {questions_asked},
+  "current_phase": {current_phase}
+}}"""
+
+
+class SimplifiedConversationManager:
+    """
+    LLM-driven conversation manager that uses dynamic prompts to handle
+    all conversation logic without hardcoded rules.
+    
+    Key features:
+    - Single dynamic prompt system
+    - LLM makes all decisions (what to ask, when to proceed, how to respond)
+    - Minimal state tracking
+    - Natural conversational responses
+    - Flexible and easy to modify through prompt updates
+    """
+    
+    def __init__(self, config_file: str = "data/config.json"):
+        """Initialize the simplified conversation manager"""
+        # Load configuration (read from disk once per path)
+        self.config = load_config(config_file)
+        
+        # Heavy dependencies are imported on first construction, not at module import
+        from common.clients import get_async_openai
+        from recommendation_engine import get_catalog, EnhancedProgressiveMatcher
+        
+        # Shared async OpenAI client on the process-wide connection pool
+        self.client = get_async_openai()
+        
+        # Vibe mapper for attribute extraction, shared across manager instances
+        self.vibe_mapper = _get_vibe_mapper(config_file)
+        
+        # Catalog and matcher are reused across turns instead of rebuilt per recommendation
+        self.catalog = get_catalog()
+        # Shared by concurrent sessions; logging is passed per call (see get_recommendations)
+        self.matcher = EnhancedProgressiveMatcher(self.catalog)
         
-        # Format conversation history (last 4 messages for context)
-        history_text = "\n".join(state.conversation_history[-4:]) if state.conversation_history else "None"
+        # Logging callback for detailed logs
+        self.log_callback = None
+        
+        # LRU cache of LLM decisions keyed by decision-relevant state signature
+        self._decision_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        
+        # Round-robin iterators over the templated question phrasings
+        self._question_cycles = {attr: itertools.cycle(templates) for attr, templates in QUESTION_TEMPLATES.items()}
+        
+        # Semantic cache so paraphrased inputs ("size M", "I wear medium") hit too
+        self.semantic_cache_config = self.config.get('semantic_cache', {})
+        self.semantic_cache = None
+        if self.semantic_cache_config.get('enabled'):
+            self.semantic_cache = SemanticCache(
+                threshold=self.semantic_cache_config['similarity_threshold'],
+                max_entries_per_bucket=self.semantic_cache_config['max_entries_per_bucket']
+            )
+            # Lookups run before the LLM call on a miss: fail fast instead of retrying
+            self.embedding_client = self.client.with_options(max_retries=0)
         
-        # Format attributes
-        attributes_text = json.dumps(state.all_attributes, indent=2) if state.all_attributes else "None"
+        # Static system prompts shared by all instances (see SYSTEM_PROMPT)
+        self.system_prompt = SYSTEM_PROMPT
+        self.combined_system_prompt = _get_combined_system_prompt(config_file)
+        self.schema_value_pattern = _get_schema_value_pattern(config_file)
+
+    def build_prompt(self, state: ConversationState, user_input: str = "") -> str:
+        """Build the dynamic user message with current conversation context"""
         
-        return self.dynamic_prompt.format(
-            original_query=state.original_query,
-            attributes=attributes_text,
-            history=history_text,
-            user_input=user_input,
+        # Conversation history (last 4 messages for context); empty history skips encoding
+        history = serialization.dumps(list(state.recent_history)) if state.recent_history else "null"
+        
+        return _render_context(
+            original_query=serialization.dumps(state.original_query),
+            attributes=state.attributes_json(),
+            history=history,
+            user_input=serialization.dumps(user_input),
             questions_asked=state.questions_asked,
-            current_phase=state.phase.value
+            current_phase=serialization.dumps(state.phase.value)
         )
 
-    def call_llm_for_decision(self, prompt: str) -> Dict[str, Any]:
-        """Call LLM to make conversation decision"""
+    def _state_signature(self, state: ConversationState) -> Dict[str, Any]:
+        """Decision-relevant view of the conversation state"""
+        attributes = state.all_attributes.get('attributes', {})
+        return {
+            "phase": state.phase.value,
+            "q": state.questions_asked,
+            "has_size": bool(attributes.get('sizes')),
+            "has_cat": bool(attributes.get('category')),
+            "query": state.original_query.strip().lower()[:128]
+        }
+
+    @staticmethod
+    def _digest(signature: Dict[str, Any]) -> str:
+        """Stable short hash of a signature dict"""
+        return hashlib.blake2b(
+            serialization.dumps(signature, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+
+    def build_decision_cache_key(self, state: ConversationState, user_input: str = "") -> str:
+        """
+        Build a canonical signature of the state that drives the LLM decision. The
+        cache is shared by all sessions and the cached message may repeat earlier
+        attributes (color, budget, fabric), so the known attributes are part of the key.
+        """
+        signature = self._state_signature(state)
+        signature["user"] = user_input.strip().lower()[:128]
+        signature["attrs"] = hashlib.blake2b(state.attributes_json().encode(), digest_size=16).hexdigest()
+        return self._digest(signature)
+
+    def build_semantic_bucket_key(self, state: ConversationState) -> str:
+        """Bucket for semantic lookups: the state signature without the user input"""
+        return self._digest(self._state_signature(state))
+
+    async def _embed_user_input(self, user_input: str):
+        """Embed user input for semantic cache lookups (None on failure or timeout)"""
+        try:
+            response = await self.embedding_client.embeddings.create(
+                model=self.semantic_cache_config['embedding_model'],
+                input=user_input.strip(),
+                # Short budget of its own: the turn's LLM call waits for this lookup
+                timeout=self.semantic_cache_config.get('embedding_timeout_seconds', 1.0)
+            )
+            return SemanticCache.normalize(response.data[0].embedding)
+        except Exception as e:
+            print(f"Semantic cache embedding error: {e}")
+            return None
+
+    async def _lookup_cached_decision(self, cache_key: Optional[str], semantic_bucket: Optional[str],
+                                user_input: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """
+        Look up a decision in the exact and semantic caches.
+
+        Returns the cached decision (or None) and the user input embedding so a
+        subsequent miss can be stored without embedding twice.
+        """
+        # Serve repeat states from the decision cache
+        if cache_key is not None:
+            cached = self._decision_cache.get(cache_key)
+            if cached is not None:
+                self._decision_cache.move_to_end(cache_key)
+                return dict(cached), None
+        
+        # Near-duplicate inputs in the same state reuse a prior decision
+        embedding = None
+        if semantic_bucket is not None and self.semantic_cache and user_input.strip():
+            embedding = await self._embed_user_input(user_input)
+            if embedding is not None:
+                similar = self.semantic_cache.lookup(semantic_bucket, embedding)
+                if similar is not None:
+                    return dict(similar), embedding
+        
+        return None, embedding
+
+    def _echoes_user_values(self, message: str, user_input: str) -> bool:
+        """
+        Whether a response repeats something specific to this input: a number, an
+        attribute value or one of the user's own words ("Got it, size M!")
+        """
+        if any(char.isdigit() for char in message) or self.schema_value_pattern.search(message):
+            return True
+        message_words = set(re.findall(r"[a-z]+", message.lower()))
+        return any(len(word) >= 4 and word in message_words for word in re.findall(r"[a-z]+", user_input.lower()))
+
+    def _store_decision(self, cache_key: Optional[str], semantic_bucket: Optional[str],
+                        embedding: Any, decision: Dict[str, Any], user_input: str):
+        """
+        Store a successful LLM decision in the exact and semantic caches. Similar
+        inputs only reuse decisions whose message doesn't echo this input's values,
+        so "size L" is never answered with the message written for "size M".
+        """
+        if cache_key is not None:
+            self._decision_cache[cache_key] = decision
+            if len(self._decision_cache) > DECISION_CACHE_SIZE:
+                self._decision_cache.popitem(last=False)
+        if embedding is not None and not self._echoes_user_values(decision["response_message"], user_input):
+            self.semantic_cache.add(semantic_bucket, embedding, decision)
+
+    async def call_llm_for_decision(self, prompt: str, cache_key: Optional[str] = None,
+                              semantic_bucket: Optional[str] = None,
+                              user_input: str = "",
+                              token_callback: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """
+        Call LLM to make conversation decision
+        
+        When token_callback is given the completion is streamed and the callback
+        receives response_message text as soon as it is generated.
+        """
+        
+        cached, embedding = await self._lookup_cached_decision(cache_key, semantic_bucket, user_input)
+        if cached is not None:
+            if token_callback:
+                token_callback(cached["response_message"])
+            return cached
         
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.config['openai']['model'],
                 messages=[
-                    {"role": "system", "content": "You are a helpful assistant that responds with valid JSON only."},
+                    {"role": "system", "content": self.system_prompt},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.7,
                 max_tokens=200,
-                timeout=self.config['openai']['timeout_seconds']
+                timeout=self.config['openai']['timeout_seconds'],
+                response_format={"type": "json_object"},
+                stream=token_callback is not None
             )
             
-            response_text = response.choices[0].message.content.strip()
+            if token_callback:
+                response_text = (await self._consume_stream(response, token_callback)).strip()
+            else:
+                response_text = response.choices[0].message.content.strip()
             
-            # Clean up response if needed
-            if response_text.startswith('```json'):
-                response_text = response_text[7:-3]
-            elif response_text.startswith('```'):
-                response_text = response_text[3:-3]
+            # JSON mode should never emit code fences; strip them anyway for older models
+            response_text = response_text.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
             
-            # Parse JSON response
-            decision = json.loads(response_text)
+            # Parse and validate in one pass with the compiled TurnDecision schema
+            # (required fields plus action/next_phase enums); failures use the fallback
+            decision = TurnDecision.model_validate_json(response_text).model_dump()
             
-            # Validate required fields
-            required_fields = ["action", "response_message", "next_phase", "reasoning"]
-            for field in required_fields:
-                if field not in decision:
-                    raise ValueError(f"Missing required field: {field}")
+            # Only successful decisions are cached, never the fallback
+            self._store_decision(cache_key, semantic_bucket, embedding, decision, user_input)
             
-            return decision
+            return dict(decision)
             
         except Exception as e:
             print(f"LLM decision error: {e}")
             # Fallback decision
             return self._get_fallback_decision()
 
+    @staticmethod
+    async def _consume_stream(stream, token_callback: Callable[[str], None]) -> str:
+        """Collect a streamed completion, forwarding response_message text as it arrives"""
+        streamer = ResponseMessageStreamer()
+        chunks = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            chunks.append(delta)
+            message_text = streamer.feed(delta)
+            if message_text:
+                token_callback(message_text)
+        return "".join(chunks)
+
+    async def _combined_call(self, user_input: str, state: ConversationState) -> Optional[Tuple[AttributeExtractionResult, Dict[str, Any]]]:
+        """
+        Single structured LLM request that both extracts attributes from the
+        user input and decides the next conversation action.
+        
+        Returns None on failure so the caller can fall back to separate calls.
+        """
+        try:
+            response = await self.client.beta.chat.completions.parse(
+                model=self.config['openai']['model'],
+                messages=[
+                    {"role": "system", "content": self.combined_system_prompt},
+                    {"role": "user", "content": self.build_prompt(state, user_input)}
+                ],
+                response_format=CombinedTurnResult,
+                temperature=self.config['openai']['temperature'],
+                # Extraction budget plus the 200 tokens of the standalone decision call
+                max_tokens=self.config['openai']['max_tokens'] + 200,
+                timeout=self.config['openai']['timeout_seconds']
+            )
+            
+            parsed = response.choices[0].message.parsed
+            if not parsed:
+                return None
+            return parsed.extracted, parsed.decision.model_dump()
+            
+        except Exception as e:
+            print(f"Combined extraction/decision error: {e}")
+            return None
+
+    def _deterministic_decision(self, state: ConversationState) -> Optional[Dict[str, Any]]:
+        """
+        Evaluate the DECISION RULES locally when they fully determine the next question.
+        
+        Only applies once attributes have been extracted (the first turn still needs the
+        LLM to read the original query) and while gathering info. Returns None when the
+        LLM is needed, including for recommendations, which get a personalized explanation.
+        """
+        if state.phase != ConversationPhase.GATHERING_INFO or 'attributes' not in state.all_attributes:
+            return None
+        if state.questions_asked >= MAX_QUESTIONS:
+            return None
+        
+        attributes = state.all_attributes['attributes']
+        missing = [attr for attr in ('sizes', 'category') if not attributes.get(attr)]
+        if not missing:
+            return None
+        
+        return {
+            "action": "ask_question",
+            "response_message": next(self._question_cycles[missing[0]]),
+            "next_phase": ConversationPhase.GATHERING_INFO.value,
+            "reasoning": f"Deterministic rule: missing {', '.join(missing)} with {state.questions_asked}/{MAX_QUESTIONS} questions asked"
+        }
+
     def _get_fallback_decision(self) -> Dict[str, Any]:
         """Fallback decision when LLM fails"""
         
@@ -152,28 +539,37 @@ Respond with JSON only:"""
             "reasoning": "Fallback: LLM error, asking for essential info"
         }
 
-    def get_recommendations(self, state: ConversationState) -> List[Any]:
-        """Get product recommendations based on conversation state"""
+    def _recommendation_context(self, state: ConversationState) -> ChainMap:
+        """
+        Snapshot of the state for the recommendation engine, safe to use off-thread.
+        
+        Attribute merges replace all_attributes rather than mutating it, so layering
+        the conversation context over the current dict needs no copy.
+        """
+        return ChainMap(
+            {
+                # Add conversation context for LLM ranking; the ranker trims the
+                # history to its character budget, so pass all of it (bounded)
+                'original_query': state.original_query,
+                'conversation_history': list(state.conversation_history)
+            },
+            state.all_attributes
+        )
+
+    async def get_recommendations(self, state: ConversationState,
+                                  context: Optional[ChainMap] = None) -> List[Any]:
+        """
+        Get product recommendations based on conversation state
+        
+        Filtering runs in a worker thread and the LLM ranking on the async client, so
+        the event loop stays free; context defaults to a snapshot of the current state.
+        """
+        session_id = state.session_id
+        if context is None:
+            context = self._recommendation_context(state)
         try:
-            from recommendation_engine import ProductCatalog, EnhancedProgressiveMatcher
-            
-            catalog = ProductCatalog()
-            matcher = EnhancedProgressiveMatcher(catalog)
-            
-            # Set up logging for recommendation engine
-            session_id = getattr(state, 'session_id', None)
-            if self.log_callback and session_id:
-                matcher.log_callback = self.log_callback
-                matcher.session_id = session_id
-            
-            # Add conversation context for LLM ranking
-            enhanced_attributes = state.all_attributes.copy()
-            enhanced_attributes['original_query'] = state.original_query
-            enhanced_attributes['conversation_history'] = state.conversation_history
-            
-            # Use the enhanced two-stage system
-            recommendations = matcher.find_recommendations(enhanced_attributes)
-            return recommendations
+            # Use the enhanced two-stage system; this session's logging travels with the call
+            return await self.matcher.find_recommendations_async(context, self.log_callback, session_id)
             
         except Exception as e:
             print(f"Error getting recommendations: {e}")
@@ -186,28 +582,30 @@ Respond with JSON only:"""
         if not products:
             return "I couldn't find exact matches, but let me broaden the search for you!"
         
-        response = f"I found {len(products)} perfect matches for you!\n\n"
+        parts = [f"I found {len(products)} perfect matches for you!\n\n"]
         for i, product in enumerate(products[:3], 1):
-            response += f"{i}. **{product.name}** - ${product.price}\n"
-            response += f"   {product.category.title()} | {product.fit} | {product.color_or_print}\n"
+            parts.append(f"{i}. **{product.name}** - ${product.price}\n")
+            parts.append(f"   {product.category.title()} | {product.fit} | {product.color_or_print}\n")
             if product.fabric:
-                response += f"   Fabric: {product.fabric}\n"
+                parts.append(f"   Fabric: {product.fabric}\n")
             if product.available_sizes:
-                response += f"   Available sizes: {', '.join(product.available_sizes)}\n"
-            response += "\n"
+                parts.append(f"   Available sizes: {', '.join(product.available_sizes)}\n")
+            parts.append("\n")
         
         if len(products) > 3:
-            response += f"...and {len(products) - 3} more great options!\n\n"
+            parts.append(f"...and {len(products) - 3} more great options!\n\n")
         
-        response += "What do you think? Would you like to see more options or make any changes?"
-        return response
+        parts.append("What do you think? Would you like to see more options or make any changes?")
+        return "".join(parts)
 
-    def extract_attributes_from_input(self, user_input: str, session_id: str = None) -> Dict[str, Any]:
+    async def extract_attributes_from_input(self, user_input: str, session_id: str = None,
+                                            llm_extraction: Optional[AttributeExtractionResult] = None) -> Dict[str, Any]:
         """Enhanced extraction using new vibe mapper with confidence scores and product info"""
         
         try:
-            # Use enhanced vibe mapper
-            result = self.vibe_mapper.map_vibe_to_attributes(user_input)
+            # Use enhanced vibe mapper (reusing an extraction from the combined call if given);
+            # a fresh extraction call is awaited on the async client
+            result = await self.vibe_mapper.map_vibe_to_attributes_async(user_input, llm_extraction)
             
             enhanced_attributes = {
                 'attributes': {},
@@ -254,39 +652,60 @@ Respond with JSON only:"""
                 self.log_callback(session_id, "error", {"message": f"Attribute extraction failed: {str(e)}"})
             return {}
 
-    def process_conversation(self, user_input: str, state: ConversationState) -> ConversationTurn:
+    async def process_conversation(self, user_input: str, state: ConversationState,
+                                   token_callback: Optional[Callable[[str], None]] = None) -> ConversationTurn:
         """
         Main method to process conversation turn using LLM decisions.
         
         Args:
             user_input: User's input (empty string for first turn)
             state: Current conversation state
+            token_callback: Optional callback receiving the LLM's response message
+                            text incrementally while the decision streams in
             
         Returns:
             ConversationTurn with LLM-generated response and next action
         """
         
+        # Get session_id from state if available
+        session_id = state.session_id
+        
+        # Cache keys describe the state before this turn's input is merged
+        cache_key = self.build_decision_cache_key(state, user_input)
+        semantic_bucket = self.build_semantic_bucket_key(state)
+        decision = None
+        
         # Extract attributes from user input if provided
         if user_input.strip():
-            # Get session_id from state if available
-            session_id = getattr(state, 'session_id', None)
-            extracted_attrs = self.extract_attributes_from_input(user_input, session_id)
+            # One LLM request for extraction + decision unless the decision is cached
+            # or the turn auto-transitions below without needing a decision
+            combined = None
+            embedding = None
+            if state.phase != ConversationPhase.READY_FOR_RECOMMENDATIONS:
+                decision, embedding = await self._lookup_cached_decision(cache_key, semantic_bucket, user_input)
+                if decision is None:
+                    combined = await self._combined_call(user_input, state)
             
-            # Merge attributes properly, preserving existing ones
-            for key, value in extracted_attrs.items():
-                if key == 'attributes':
-                    # Merge attribute dictionaries
-                    if 'attributes' not in state.all_attributes:
-                        state.all_attributes['attributes'] = {}
-                    state.all_attributes['attributes'].update(value)
-                elif key == 'confidence_scores':
-                    # Merge confidence scores
-                    if 'confidence_scores' not in state.all_attributes:
-                        state.all_attributes['confidence_scores'] = {}
-                    state.all_attributes['confidence_scores'].update(value)
-                else:
-                    # For other keys, just update
-                    state.all_attributes[key] = value
+            if combined is not None:
+                llm_extraction, decision = combined
+                self._store_decision(cache_key, semantic_bucket, embedding, decision, user_input)
+                extracted_attrs = await self.extract_attributes_from_input(user_input, session_id, llm_extraction)
+            else:
+                extracted_attrs = await self.extract_attributes_from_input(user_input, session_id)
+            
+            # Merge attributes properly, preserving existing ones; build new dicts
+            # (copy-on-write) so recommendation snapshots never see a partial merge
+            if extracted_attrs:
+                merged = dict(state.all_attributes)
+                for key, value in extracted_attrs.items():
+                    if key in ('attributes', 'confidence_scores'):
+                        # Merge attribute dictionaries and confidence scores
+                        merged[key] = {**merged.get(key, {}), **value}
+                    else:
+                        # For other keys, just update
+                        merged[key] = value
+                state.all_attributes = merged
+                state.mark_attributes_changed()
             
             state.add_to_history(f"User: {user_input}")
         
@@ -301,14 +720,16 @@ Respond with JSON only:"""
                 next_phase=ConversationPhase.HANDLING_CHANGES
             )
 
-        # Build dynamic prompt with current context
-        prompt = self.build_prompt(state, user_input)
+        # Skip the LLM when the decision rules already determine the next question
+        if decision is None:
+            decision = self._deterministic_decision(state)
         
-        # Get LLM decision
-        decision = self.call_llm_for_decision(prompt)
+        # Get LLM decision with the current context unless the combined call made it
+        if decision is None:
+            prompt = self.build_prompt(state, user_input)
+            decision = await self.call_llm_for_decision(prompt, cache_key, semantic_bucket, user_input, token_callback)
         
         # Log LLM decision details if callback is available
-        session_id = getattr(state, 'session_id', None)
         if self.log_callback and session_id:
             self.log_callback(session_id, "llm_decision", {
                 "reasoning": decision.get("reasoning"),
@@ -318,11 +739,11 @@ Respond with JSON only:"""
         
         # Update state based on decision
         response_message = decision["response_message"]
-        next_phase = ConversationPhase(decision["next_phase"])
+        next_phase = _PHASE_BY_VALUE[decision["next_phase"]]
         action = decision["action"]
         
         # Safety validation: Ensure LLM respects question limits
-        if action == "ask_question" and state.questions_asked >= 2:
+        if action == "ask_question" and state.questions_asked >= MAX_QUESTIONS:
             print("DEBUG: LLM tried to ask question after limit, forcing recommendations")
             action = "ready_for_recommendations"
             next_phase = ConversationPhase.READY_FOR_RECOMMENDATIONS
@@ -331,7 +752,7 @@ Respond with JSON only:"""
         # Get recommendations if action is ready_for_recommendations
         recommendations = None
         if action == "ready_for_recommendations":
-            recommendations = self.get_recommendations(state)
+            recommendations = await self.get_recommendations(state)
             if not recommendations:
                 response_message = "I'm having trouble finding matches right now. Could you tell me a bit more about what you're looking for?"
             # If we have recommendations, the LLM already provided the explanation in response_message
@@ -355,15 +776,16 @@ Respond with JSON only:"""
         )
 
     # Legacy compatibility methods
-    def process_conversation_turn(self, user_input: str, existing_attributes: Dict[str, Any], 
-                                conversation_state: ConversationState) -> ConversationTurn:
+    async def process_conversation_turn(self, user_input: str, existing_attributes: Dict[str, Any], 
+                                      conversation_state: ConversationState) -> ConversationTurn:
         """Legacy method for backward compatibility"""
         
         # Merge existing attributes into state
-        conversation_state.all_attributes.update(existing_attributes)
+        conversation_state.all_attributes = {**conversation_state.all_attributes, **existing_attributes}
+        conversation_state.mark_attributes_changed()
         
         # Use new simplified method
-        return self.process_conversation(user_input, conversation_state)
+        return await self.process_conversation(user_input, conversation_state)
 
     def find_missing_attributes(self, existing_attributes: Dict[str, Any]) -> List[str]:
         """Legacy method for backward compatibility"""
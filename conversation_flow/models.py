@@ -1,9 +1,16 @@
 """
 Simplified data models for the Conversation Flow Manager
 """
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, List, Any, Optional
+from typing import Deque, Dict, List, Any, Optional, Tuple
 from enum import Enum
+from common import serialization
+
+# Messages retained per session; older turns are dropped
+HISTORY_MAX_MESSAGES = 32
+# Messages given to the LLM as recent context
+RECENT_HISTORY_MESSAGES = 4
 
 
 class ConversationPhase(Enum):
@@ -13,18 +20,44 @@ class ConversationPhase(Enum):
     HANDLING_CHANGES = "handling_changes"
 
 
-@dataclass
+@dataclass(slots=True)
 class ConversationState:
     """Minimal conversation state tracking"""
     original_query: str
     phase: ConversationPhase = ConversationPhase.GATHERING_INFO
     all_attributes: Dict[str, Any] = field(default_factory=dict)
-    conversation_history: List[str] = field(default_factory=list)
+    conversation_history: Deque[str] = field(default_factory=lambda: deque(maxlen=HISTORY_MAX_MESSAGES))
     questions_asked: int = 0
+    session_id: Optional[str] = None  # Set by the API layer for per-session logging
+    # Bumped on every all_attributes mutation so its JSON can be cached between turns
+    _attrs_version: int = field(default=0, init=False, repr=False)
+    _attrs_json_cache: Tuple[int, str] = field(default=(-1, ""), init=False, repr=False)
+    recent_history: Deque[str] = field(
+        default_factory=lambda: deque(maxlen=RECENT_HISTORY_MESSAGES), init=False, repr=False
+    )
+    
+    def __post_init__(self):
+        # Callers may still pass a plain list; keep the history bounded either way
+        if not isinstance(self.conversation_history, deque) or self.conversation_history.maxlen is None:
+            self.conversation_history = deque(self.conversation_history, maxlen=HISTORY_MAX_MESSAGES)
+        self.recent_history.extend(self.conversation_history)
     
     def add_to_history(self, message: str):
         """Add a message to conversation history"""
         self.conversation_history.append(message)
+        self.recent_history.append(message)
+    
+    def mark_attributes_changed(self):
+        """Invalidate the cached attributes JSON after mutating all_attributes"""
+        self._attrs_version += 1
+    
+    def attributes_json(self) -> str:
+        """JSON encoding of all_attributes, re-serialized only after a change"""
+        if not self.all_attributes:
+            return "null"
+        if self._attrs_json_cache[0] != self._attrs_version:
+            self._attrs_json_cache = (self._attrs_version, serialization.dumps(self.all_attributes))
+        return self._attrs_json_cache[1]
     
     def has_essential_attributes(self) -> bool:
         """Check if we have the essential attributes for recommendations"""
@@ -33,7 +66,7 @@ class ConversationState:
         return has_size and has_category
 
 
-@dataclass
+@dataclass(slots=True)
 class ConversationTurn:
     """Result of processing one conversation turn"""
     action: str
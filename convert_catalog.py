@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+One-shot conversion of the Excel product catalog to Parquet
+
+ProductCatalog loads the Parquet file instead of parsing the Excel workbook
+whenever it is at least as new as the source. Re-run after editing the Excel file.
+"""
+import sys
+import pandas as pd
+from recommendation_engine.catalog import parquet_path_for
+
+
+def convert(excel_path: str = "Apparels_shared.xlsx") -> str:
+    """Write the Parquet copy of an Excel catalog and return its path"""
+    df = pd.read_excel(excel_path)
+    parquet_path = parquet_path_for(excel_path)
+    df.to_parquet(parquet_path, engine="pyarrow", index=False)
+    print(f"✅ Converted {len(df)} products: {excel_path} -> {parquet_path}")
+    return parquet_path
+
+
+if __name__ == "__main__":
+    convert(*sys.argv[1:2])
@@ -0,0 +1,23 @@
+"""
+Gunicorn configuration for production / containerized deployment
+
+    gunicorn -c gunicorn_conf.py main:app
+
+Sessions must be shared between workers, so set REDIS_URL (see session_store.py).
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# Uvicorn workers use uvloop/httptools when installed (uvicorn[standard])
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app (catalog, prompts, clients) once in the master so workers
+# share that read-only memory copy-on-write after fork
+preload_app = True
+
+# LLM-backed turns can take a while; keep idle keep-alive connections warm
+timeout = 120
+keepalive = 75
@@ -4,11 +4,15 @@ Minimalistic FastAPI backend for Vibe Shopping Chat Interface
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from typing import AsyncIterator, Callable, List, Optional, Dict, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
 import uuid
 import os
-from datetime import datetime
+import time
 
 # Clear any existing OPENAI_API_KEY from environment before loading .env
 if 'OPENAI_API_KEY' in os.environ:
@@ -20,8 +24,41 @@ load_dotenv(override=True)
 
 from conversation_flow import SimplifiedConversationManager, ConversationState
 from recommendation_engine import EnhancedProgressiveMatcher, ProductCatalog
+from session_store import create_session_store
+from common import serialization
 
-app = FastAPI(title="Vibe Shopping API", version="1.0.0")
+# Encode responses with orjson when it is installed (several times faster than json.dumps).
+# FastAPI releases that deprecate ORJSONResponse already serialize response models
+# to JSON bytes through pydantic-core, so they keep their default response class.
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse
+    DefaultResponse = JSONResponse if hasattr(ORJSONResponse, '__deprecated__') else ORJSONResponse
+except ImportError:
+    DefaultResponse = JSONResponse
+
+# Worker threads for the synchronous engines (vibe mapper, recommendations) that
+# conversation turns offload with asyncio.to_thread; bounds concurrent blocking work
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '100'))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="vibe-worker")
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Embed the catalog before serving so the first session doesn't wait for it
+    try:
+        await asyncio.to_thread(conversation_manager.matcher.warm_up)
+    except Exception as e:
+        print(f"⚠️ Embedding index warm-up failed, building on first use: {e}")
+    yield
+    executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(
+    title="Vibe Shopping API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=DefaultResponse
+)
 
 # Enable CORS for React frontend
 app.add_middleware(
@@ -32,9 +69,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory session storage (simple approach)
-sessions: Dict[str, ConversationState] = {}
-session_logs: Dict[str, List[str]] = {}
+# Session storage (Redis when REDIS_URL is set, in-memory otherwise)
+session_store = create_session_store()
+
+# Logs captured during the current request as (timestamp, prefix, message);
+# formatted and flushed to the session store when the request ends
+pending_logs: Dict[str, List[Tuple[float, str, str]]] = {}
+
+# Log type prefixes for better categorization
+LOG_TYPE_PREFIXES = {
+    "info": "ℹ️",
+    "success": "✅", 
+    "warning": "⚠️",
+    "error": "❌",
+    "debug": "🔍",
+    "llm": "🧠",
+    "filter": "🎯",
+    "extract": "📊"
+}
 
 # Initialize conversation manager
 conversation_manager = SimplifiedConversationManager()
@@ -44,10 +96,26 @@ class ChatMessage(BaseModel):
     message: str
     session_id: Optional[str] = None
 
+class ProductResponse(BaseModel):
+    """Product as returned by the API, read straight from Product attributes"""
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: str
+    name: str
+    price: float
+    category: str
+    fit: Optional[str] = None
+    fabric: Optional[str] = None
+    color_or_print: Optional[str] = None
+    occasion: Optional[str] = None
+    available_sizes: List[str]
+    ranking_score: Optional[float] = None
+    ranking_reasoning: Optional[str] = None
+
 class ChatResponse(BaseModel):
     response: str
     session_id: str
-    recommendations: List[Dict[str, Any]] = []
+    recommendations: List[ProductResponse] = []
     action: str
     phase: str
 
@@ -58,49 +126,23 @@ class SessionLogs(BaseModel):
     session_id: str
     logs: List[str]
 
-def format_product_for_api(product) -> Dict[str, Any]:
-    """Format product object for API response"""
-    return {
-        "id": product.id,
-        "name": product.name,
-        "price": product.price,
-        "category": product.category,
-        "fit": product.fit,
-        "fabric": product.fabric,
-        "color_or_print": product.color_or_print,
-        "occasion": product.occasion,
-        "available_sizes": product.available_sizes,
-        "ranking_score": getattr(product, 'ranking_score', None),
-        "ranking_reasoning": getattr(product, 'ranking_reasoning', None)
-    }
-
 def capture_logs(session_id: str, message: str, log_type: str = "info"):
-    """Capture logs for debugging with categorization"""
-    if session_id not in session_logs:
-        session_logs[session_id] = []
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
-    # Add log type prefix for better categorization
-    type_prefix = {
-        "info": "ℹ️",
-        "success": "✅", 
-        "warning": "⚠️",
-        "error": "❌",
-        "debug": "🔍",
-        "llm": "🧠",
-        "filter": "🎯",
-        "extract": "📊"
-    }.get(log_type, "ℹ️")
-    
-    session_logs[session_id].append(f"[{timestamp}] {type_prefix} {message}")
+    """Capture logs for debugging with categorization (formatted when flushed)"""
+    type_prefix = LOG_TYPE_PREFIXES.get(log_type, "ℹ️")
+    pending_logs.setdefault(session_id, []).append((time.time(), type_prefix, message))
+
+async def flush_logs(session_id: str):
+    """Persist logs captured for a session to the session store"""
+    entries = pending_logs.pop(session_id, None)
+    if entries:
+        lines = [
+            f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {type_prefix} {message}"
+            for timestamp, type_prefix, message in entries
+        ]
+        await session_store.append_logs(session_id, lines)
 
 def capture_detailed_logs(session_id: str, component: str, details: dict):
     """Capture detailed structured logs from components"""
-    if session_id not in session_logs:
-        session_logs[session_id] = []
-    
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
     if component == "attribute_extraction":
         if details.get('attributes'):
             for attr, values in details['attributes'].items():
@@ -144,113 +186,141 @@ async def root():
 async def health():
     return {"status": "healthy", "service": "vibe-shopping-api"}
 
+def internal_error(session_id: str, action: str, exc: Exception) -> HTTPException:
+    """
+    500 for an unexpected endpoint error, noted in the session's debug log.
+    
+    Raised as an HTTPException (not left to an Exception handler) so the
+    response still passes through CORSMiddleware.
+    """
+    print(f"❌ Error {action}: {exc!r}")
+    capture_logs(session_id, f"❌ Error {action}: {exc}", "error")
+    return HTTPException(status_code=500, detail=f"Error {action}: {exc}")
+
+async def run_turn(state: ConversationState, user_input: str,
+                   token_callback: Optional[Callable[[str], None]] = None) -> ChatResponse:
+    """Process one conversation turn, save the session and build the API response"""
+    session_id = state.session_id
+    turn = await conversation_manager.process_conversation(user_input, state, token_callback)
+    await session_store.save(state)
+    
+    capture_logs(session_id, f"📝 Action: {turn.action}, Phase: {turn.phase.value}")
+    
+    # Recommendations are serialized by ProductResponse
+    recommendations = turn.recommendations or []
+    if recommendations:
+        capture_logs(session_id, f"🏆 Generated {len(recommendations)} recommendations")
+    
+    return ChatResponse(
+        response=turn.response_message,
+        session_id=session_id,
+        recommendations=recommendations,
+        action=turn.action,
+        phase=turn.phase.value
+    )
+
+def sse_event(event: str, data: str) -> str:
+    """One Server-Sent Events message (data is single-line JSON)"""
+    return f"event: {event}\ndata: {data}\n\n"
+
+def stream_turn(state: ConversationState, user_input: str, action: str) -> StreamingResponse:
+    """
+    Run a turn as Server-Sent Events: "token" events carry response text as the LLM
+    writes it, then one "done" event carries the ChatResponse ("error" on failure).
+    Turns answered without a streamed LLM call send no tokens, only "done".
+    """
+    session_id = state.session_id
+    
+    async def events() -> AsyncIterator[str]:
+        tokens: asyncio.Queue = asyncio.Queue()
+        turn = asyncio.create_task(run_turn(state, user_input, tokens.put_nowait))
+        turn.add_done_callback(lambda _: tokens.put_nowait(None))
+        try:
+            while (token := await tokens.get()) is not None:
+                yield sse_event("token", serialization.dumps({"text": token}))
+            yield sse_event("done", turn.result().model_dump_json())
+        except Exception as exc:
+            error = internal_error(session_id, action, exc)
+            yield sse_event("error", serialization.dumps({"detail": error.detail}))
+        finally:
+            # Client gone mid-turn: don't leave the turn running
+            turn.cancel()
+            await flush_logs(session_id)
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def new_session(initial_query: str) -> ConversationState:
+    """Create the state for a new conversation"""
+    session_id = str(uuid.uuid4())
+    capture_logs(session_id, f"🚀 Started new session with query: '{initial_query}'")
+    return ConversationState(original_query=initial_query, session_id=session_id)
+
+async def existing_session(message: ChatMessage) -> ConversationState:
+    """State of the message's session (404 if unknown)"""
+    state = await session_store.get(message.session_id) if message.session_id else None
+    if state is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    capture_logs(state.session_id, f"💬 User message: '{message.message}'")
+    return state
+
 @app.post("/api/chat/start", response_model=ChatResponse)
 async def start_conversation(request: NewSessionRequest):
     """Start a new conversation session"""
+    state = new_session(request.initial_query)
     try:
-        # Create new session
-        session_id = str(uuid.uuid4())
-        state = ConversationState(original_query=request.initial_query)
-        state.session_id = session_id  # Add session_id to state for logging
-        sessions[session_id] = state
-        session_logs[session_id] = []
-        
-        capture_logs(session_id, f"🚀 Started new session with query: '{request.initial_query}'")
-        
         # Process initial query
-        turn = conversation_manager.process_conversation("", state)
-        
-        capture_logs(session_id, f"📝 Action: {turn.action}, Phase: {turn.phase.value}")
-        
-        # Format recommendations if any
-        recommendations = []
-        if turn.recommendations:
-            recommendations = [format_product_for_api(product) for product in turn.recommendations]
-            capture_logs(session_id, f"🏆 Generated {len(recommendations)} recommendations")
-        
-        return ChatResponse(
-            response=turn.response_message,
-            session_id=session_id,
-            recommendations=recommendations,
-            action=turn.action,
-            phase=turn.phase.value
-        )
-        
-    except Exception as e:
-        capture_logs(session_id if 'session_id' in locals() else "unknown", f"❌ Error starting conversation: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error starting conversation: {str(e)}")
+        return await run_turn(state, "")
+    except Exception as exc:
+        raise internal_error(state.session_id, "starting conversation", exc) from exc
+    finally:
+        await flush_logs(state.session_id)
+
+@app.post("/api/chat/start/stream")
+async def start_conversation_stream(request: NewSessionRequest):
+    """Start a new conversation session, streaming the response (see stream_turn)"""
+    return stream_turn(new_session(request.initial_query), "", "starting conversation")
 
 @app.post("/api/chat/message", response_model=ChatResponse)
 async def send_message(message: ChatMessage):
     """Send a message in an existing conversation"""
+    state = await existing_session(message)
     try:
-        session_id = message.session_id
-        if not session_id or session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        state = sessions[session_id]
-        capture_logs(session_id, f"💬 User message: '{message.message}'")
-        
         # Process the message
-        turn = conversation_manager.process_conversation(message.message, state)
-        
-        capture_logs(session_id, f"📝 Action: {turn.action}, Phase: {turn.phase.value}")
-        
-        # Format recommendations if any
-        recommendations = []
-        if turn.recommendations:
-            recommendations = [format_product_for_api(product) for product in turn.recommendations]
-            capture_logs(session_id, f"🏆 Generated {len(recommendations)} recommendations")
-        
-        return ChatResponse(
-            response=turn.response_message,
-            session_id=session_id,
-            recommendations=recommendations,
-            action=turn.action,
-            phase=turn.phase.value
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        capture_logs(session_id if session_id else "unknown", f"❌ Error processing message: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
+        return await run_turn(state, message.message)
+    except Exception as exc:
+        raise internal_error(state.session_id, "processing message", exc) from exc
+    finally:
+        await flush_logs(state.session_id)
+
+@app.post("/api/chat/message/stream")
+async def send_message_stream(message: ChatMessage):
+    """Send a message in an existing conversation, streaming the response (see stream_turn)"""
+    state = await existing_session(message)
+    return stream_turn(state, message.message, "processing message")
 
 @app.delete("/api/chat/{session_id}")
 async def clear_conversation(session_id: str):
     """Clear a conversation session"""
-    try:
-        if session_id in sessions:
-            del sessions[session_id]
-        if session_id in session_logs:
-            del session_logs[session_id]
-        
-        return {"message": "Session cleared successfully"}
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error clearing session: {str(e)}")
+    await session_store.delete(session_id)
+    pending_logs.pop(session_id, None)
+    return {"message": "Session cleared successfully"}
 
 @app.get("/api/debug/logs/{session_id}", response_model=SessionLogs)
 async def get_session_logs(session_id: str):
     """Get debug logs for a session"""
-    try:
-        if session_id not in session_logs:
-            return SessionLogs(session_id=session_id, logs=[])
-        
-        return SessionLogs(
-            session_id=session_id,
-            logs=session_logs[session_id]
-        )
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error retrieving logs: {str(e)}")
+    await flush_logs(session_id)
+    return SessionLogs(
+        session_id=session_id,
+        logs=await session_store.get_logs(session_id)
+    )
 
 @app.get("/api/sessions")
 async def list_sessions():
     """List all active sessions (for debugging)"""
+    session_ids = await session_store.list_ids()
     return {
-        "active_sessions": len(sessions),
-        "session_ids": list(sessions.keys())
+        "active_sessions": len(session_ids),
+        "session_ids": session_ids
     }
 
 # Serve static files for React frontend (if built)
@@ -262,4 +332,22 @@ if __name__ == "__main__":
     print("🛍️ Starting Vibe Shopping API...")
     print("📡 API will be available at: http://localhost:8000")
     print("📚 API docs will be available at: http://localhost:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    
+    # Development: auto-reload, single worker. Otherwise one worker per CPU, which
+    # needs shared session storage (REDIS_URL); in-memory sessions stay single-worker
+    development = os.getenv('ENVIRONMENT') == 'development'
+    workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+    if development or not os.getenv('REDIS_URL'):
+        workers = 1
+    
+    # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard])
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=development,
+        workers=workers,
+        loop="auto",
+        http="auto",
+        log_level="info"
+    )
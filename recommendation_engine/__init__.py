@@ -5,13 +5,15 @@ Progressive confidence-based product matching system.
 """
 
 from .models import Product, AttributeFilter, PriceFilter
-from .catalog import ProductCatalog
+from .catalog import ProductCatalog, get_catalog
 from .progressive_matcher import ProgressiveMatcher
 from .llm_ranker import LLMRanker
 from .enhanced_matcher import EnhancedProgressiveMatcher, HybridMatcher
+from common.clients import get_openai, get_async_openai
 
 __all__ = [
     'Product', 'AttributeFilter', 'PriceFilter', 
-    'ProductCatalog', 'ProgressiveMatcher',
-    'LLMRanker', 'EnhancedProgressiveMatcher', 'HybridMatcher'
+    'ProductCatalog', 'get_catalog', 'ProgressiveMatcher',
+    'LLMRanker', 'EnhancedProgressiveMatcher', 'HybridMatcher',
+    'get_openai', 'get_async_openai'
 ]
@@ -1,93 +1,227 @@
 """
-Product catalog management - loads products from Excel file
+Product catalog management - loads products from Parquet (or the source Excel file)
 """
+import functools
+import logging
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+import numpy as np
 import pandas as pd
-import traceback
-from typing import List
-from .models import Product
+from typing import Dict, Iterable, List, Optional
+from .models import Product, SIZE_BITS
+
+logger = logging.getLogger(__name__)
+
+# Optional text attributes copied onto Product as str or None
+OPTIONAL_TEXT_COLUMNS = [
+    'fit', 'fabric', 'sleeve_length', 'color_or_print',
+    'occasion', 'neckline', 'length', 'pant_type'
+]
+
+# Attribute names a filter can match on ('sizes' checks available_sizes)
+FILTERABLE_ATTRIBUTES = frozenset(['category', 'sizes'] + OPTIONAL_TEXT_COLUMNS)
+
+
+def parquet_path_for(excel_path: str) -> str:
+    """Location of the Parquet conversion of an Excel catalog (see convert_catalog.py)"""
+    return os.path.splitext(excel_path)[0] + ".parquet"
+
+
+@dataclass
+class CatalogArrays:
+    """
+    Structure-of-arrays view of the catalog for vectorized filtering.
+    
+    Row i describes catalog.products[i]; filters combine boolean masks and only
+    the surviving rows are materialized back into Product objects.
+    """
+    price: np.ndarray                     # float64 (exact comparisons with Product.price)
+    codes: Dict[str, np.ndarray]          # attribute -> category codes, -1 = missing (int8 up to 127 values)
+    vocab: Dict[str, Dict[str, int]]      # attribute -> value -> code
+    postings: Dict[str, List[np.ndarray]] # attribute -> code -> int32 rows with that value
+    size_mask: np.ndarray                 # uint8 canonical-size bitmask (see SIZE_BITS)
+    other_sizes: Dict[str, np.ndarray]    # non-canonical size -> bool availability column
+    
+    @classmethod
+    def from_products(cls, products: List[Product]) -> 'CatalogArrays':
+        """Build the columns from loaded products"""
+        codes = {}
+        vocab = {}
+        postings = {}
+        for attr in ['category'] + OPTIONAL_TEXT_COLUMNS:
+            column = pd.Categorical([getattr(p, attr) or None for p in products])
+            # pandas picks the narrowest signed code type for the vocabulary size
+            codes[attr] = column.codes
+            vocab[attr] = {value: code for code, value in enumerate(column.categories)}
+            
+            # Inverted index: rows grouped by code (missing values, code -1, sort first)
+            order = np.argsort(codes[attr], kind='stable').astype(np.int32)
+            bounds = np.searchsorted(codes[attr][order], np.arange(len(column.categories) + 1))
+            postings[attr] = [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        
+        other_sizes = defaultdict(lambda: np.zeros(len(products), dtype=bool))
+        for i, product in enumerate(products):
+            for size in product.available_sizes:
+                if size.upper() not in SIZE_BITS:
+                    other_sizes[size][i] = True
+        
+        return cls(
+            price=np.array([p.price for p in products], dtype=np.float64),
+            codes=codes,
+            vocab=vocab,
+            postings=postings,
+            size_mask=np.array([p.size_mask for p in products], dtype=np.uint8),
+            other_sizes=dict(other_sizes)
+        )
+    
+    def attribute_mask(self, name: str, values: Iterable[str]) -> np.ndarray:
+        """Rows whose attribute equals any of the values (sizes: any value available)"""
+        if name == 'sizes':
+            mask = np.zeros(len(self.price), dtype=bool)
+            bits = 0
+            for size in values:
+                bit = SIZE_BITS.get(size.upper())
+                if bit is not None:
+                    bits |= 1 << bit
+                elif size in self.other_sizes:
+                    mask |= self.other_sizes[size]
+            if bits:
+                mask |= (self.size_mask & bits) != 0
+            return mask
+        
+        mask = np.zeros(len(self.price), dtype=bool)
+        postings = self.postings.get(name)
+        if postings is None:
+            # Not a product attribute, so nothing can match it
+            return mask
+        # Only the rows posted under the wanted values are touched
+        for value in values:
+            code = self.vocab[name].get(value)
+            if code is not None:
+                mask[postings[code]] = True
+        return mask
+    
+    def price_mask(self, min_price: float = None, max_price: float = None) -> np.ndarray:
+        """Rows within the price range (unset/zero bounds are open)"""
+        mask = np.ones(len(self.price), dtype=bool)
+        if min_price:
+            mask &= self.price >= min_price
+        if max_price:
+            mask &= self.price <= max_price
+        return mask
 
 
 class ProductCatalog:
     """Manages product catalog loaded from Excel file"""
     
     def __init__(self, excel_path: str = "Apparels_shared.xlsx"):
-        self.products = self.load_products_from_excel(excel_path)
-        print(f"Loaded {len(self.products)} products from catalog")
+        self.products = self.load_products(excel_path)
+        if not self.products:
+            # Refuse to serve an empty catalog; the cause was logged by load_products
+            raise RuntimeError(f"No products could be loaded from {excel_path}")
+        logger.info("Loaded %d products from catalog", len(self.products))
+        self.build_indexes()
+    
+    def build_indexes(self):
+        """Precompute lookup indexes over the loaded products (catalog order preserved)"""
+        self._by_id: Dict[str, Product] = {}
+        self._row_by_id: Dict[str, int] = {}
+        self._by_category: Dict[str, List[Product]] = defaultdict(list)
+        for row, product in enumerate(self.products):
+            self._by_id[product.id] = product
+            self._row_by_id[product.id] = row
+            self._by_category[product.category.lower()].append(product)
+        
+        # Column view used by vectorized filters
+        self.arrays = CatalogArrays.from_products(self.products)
     
-    def load_products_from_excel(self, path: str) -> List[Product]:
-        """Load products from Excel file and convert to Product objects"""
+    def products_from_mask(self, mask: np.ndarray, limit: Optional[int] = None) -> List[Product]:
+        """Materialize the products selected by a row mask (the first `limit` of them), in catalog order"""
+        return [self.products[i] for i in np.flatnonzero(mask)[:limit]]
+    
+    def rows_of(self, products: List[Product]) -> np.ndarray:
+        """Catalog row numbers of catalog products (for indexing masks)"""
+        return np.fromiter((self._row_by_id[p.id] for p in products), dtype=np.int32, count=len(products))
+    
+    @staticmethod
+    def read_catalog_frame(path: str) -> pd.DataFrame:
+        """Read the catalog table, preferring an up-to-date Parquet conversion over Excel"""
+        parquet_path = parquet_path_for(path)
+        if os.path.exists(parquet_path) and (
+            not os.path.exists(path) or os.path.getmtime(parquet_path) >= os.path.getmtime(path)
+        ):
+            try:
+                # Memory-map the file so the read goes through the shared page cache
+                return pd.read_parquet(parquet_path, engine="pyarrow", memory_map=True)
+            except ImportError:
+                logger.debug("No Parquet engine installed, reading %s instead", path)
+        return pd.read_excel(path)
+    
+    def load_products(self, path: str) -> List[Product]:
+        """Load products from the catalog file and convert to Product objects"""
         try:
-            # Read Excel file
-            df = pd.read_excel(path)
-            products = []
+            df = self.read_catalog_frame(path)
             
-            for i, row in df.iterrows():
-                try:
-                    print(f"DEBUG: Loading product {i}: {row.get('name', 'unknown')}")
-                    
-                    # Parse sizes from comma-separated string with robust error handling
-                    try:
-                        raw_sizes = row['available_sizes']
-                        print(f"DEBUG: Raw available_sizes: {raw_sizes} (type: {type(raw_sizes)})")
-                        
-                        sizes_str = str(raw_sizes) if pd.notna(raw_sizes) else ""
-                        print(f"DEBUG: Converted to string: '{sizes_str}'")
-                        
-                        if sizes_str and sizes_str != 'nan':
-                            available_sizes = [size.strip() for size in sizes_str.split(',') if size.strip()]
-                        else:
-                            available_sizes = []
-                        
-                        print(f"DEBUG: Final available_sizes: {available_sizes} (type: {type(available_sizes)})")
-                        
-                    except Exception as e:
-                        print(f"ERROR: Parsing sizes for product {row.get('name', 'unknown')}: {e}")
-                        print(f"ERROR: Full traceback:")
-                        print(traceback.format_exc())
-                        available_sizes = []
-                    
-                    # Create Product object
-                    product = Product(
-                        id=str(row['id']),
-                        name=str(row['name']),
-                        category=str(row['category']),
-                        available_sizes=available_sizes,
-                        fit=str(row['fit']) if pd.notna(row['fit']) else None,
-                        fabric=str(row['fabric']) if pd.notna(row['fabric']) else None,
-                        sleeve_length=str(row['sleeve_length']) if pd.notna(row['sleeve_length']) else None,
-                        color_or_print=str(row['color_or_print']) if pd.notna(row['color_or_print']) else None,
-                        occasion=str(row['occasion']) if pd.notna(row['occasion']) else None,
-                        neckline=str(row['neckline']) if pd.notna(row['neckline']) else None,
-                        length=str(row['length']) if pd.notna(row['length']) else None,
-                        pant_type=str(row['pant_type']) if pd.notna(row['pant_type']) else None,
-                        price=float(row['price'])
-                    )
-                    
-                    # Validate the created product
-                    print(f"DEBUG: Created product with available_sizes: {product.available_sizes} (type: {type(product.available_sizes)})")
-                    
-                    products.append(product)
-                    
-                except Exception as e:
-                    print(f"ERROR: Failed to create product {i}: {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
-                    print(f"ERROR: Row data: {dict(row)}")
+            # Rows without a usable id, name, category or price are skipped, not fatal
+            price = pd.to_numeric(df['price'], errors='coerce')
+            bad = price.isna() | df[['id', 'name', 'category']].isna().any(axis=1)
+            if bad.any():
+                logger.warning(
+                    "Skipping %d catalog rows with a missing id/name/category or non-numeric price (rows %s)",
+                    int(bad.sum()), df.index[bad].tolist()[:20]
+                )
+                df = df[~bad]
+                price = price[~bad]
+            
+            # Parse sizes from comma-separated strings, dropping blanks
+            available_sizes = df['available_sizes'].fillna('').astype(str).str.split(',').apply(
+                lambda sizes: tuple(size.strip() for size in sizes if size.strip())
+            )
             
+            # Normalize column types in bulk; missing optional attributes become None
+            optional = df[OPTIONAL_TEXT_COLUMNS]
+            columns = {
+                'id': df['id'].astype(str),
+                'name': df['name'].astype(str),
+                'category': df['category'].astype(str),
+                'available_sizes': available_sizes,
+                'price': price.astype(float)
+            }
+            frame = pd.DataFrame(columns).join(
+                optional.astype(str).astype(object).where(optional.notna(), None)
+            )
+            
+            products = []
+            for record in frame.to_dict(orient="records"):
+                try:
+                    products.append(Product(**record))
+                except Exception:
+                    logger.warning("Skipping catalog product %s", record.get('id'), exc_info=True)
             return products
             
-        except Exception as e:
-            print(f"Error loading products from {path}: {e}")
+        except Exception:
+            logger.exception("Error loading products from %s", path)
             return []
     
     def get_products_by_category(self, category: str) -> List[Product]:
         """Get all products in a specific category"""
-        return [p for p in self.products if p.category.lower() == category.lower()]
+        return list(self._by_category.get(category.lower(), []))
     
     def get_products_in_price_range(self, min_price: float = None, max_price: float = None) -> List[Product]:
         """Get products within a price range"""
-        return [p for p in self.products if p.matches_price_range(min_price, max_price)]
+        return self.products_from_mask(self.arrays.price_mask(min_price, max_price))
     
     def get_products_by_size(self, size: str) -> List[Product]:
         """Get products available in a specific size"""
-        return [p for p in self.products if p.matches_size(size)]
+        return self.products_from_mask(self.arrays.attribute_mask('sizes', [size]))
+    
+    def get_product(self, product_id: str) -> Optional[Product]:
+        """Get a product by id"""
+        return self._by_id.get(product_id)
+
+
+@functools.lru_cache(maxsize=1)
+def get_catalog(excel_path: str = "Apparels_shared.xlsx") -> ProductCatalog:
+    """Process-wide product catalog, loaded once on first use"""
+    return ProductCatalog(excel_path)
@@ -0,0 +1,137 @@
+"""
+Product embedding index for cosine-similarity ranking of candidates
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+from common.clients import get_openai
+from .models import Product
+
+# Query embeddings kept in memory (queries repeat across turns of a session)
+QUERY_CACHE_SIZE = 256
+
+# Texts per embeddings request (the API accepts at most 2048 inputs per request)
+EMBEDDING_BATCH_SIZE = 512
+
+
+class ProductEmbeddingIndex:
+    """
+    L2-normalized embeddings for every catalog product, built with batched
+    embeddings requests (at startup via build(), or on first use) and persisted
+    to cache_path so restarts only re-embed when the catalog or model changes.
+    """
+
+    def __init__(self, products: List[Product], model: str, cache_path: Optional[str] = None):
+        self.products = products
+        self.model = model
+        self.cache_path = cache_path
+        self.client = get_openai()
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._row_by_id: Dict[str, int] = {}
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+
+    @staticmethod
+    def product_text(product: Product) -> str:
+        """Descriptive text embedded for a product"""
+        parts = [product.name, product.category, product.fabric, product.color_or_print, product.occasion]
+        return " ".join(part for part in parts if part)
+
+    @staticmethod
+    def normalize(matrix: np.ndarray) -> np.ndarray:
+        """Scale rows to unit length so dot products are cosine similarities"""
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = self.client.embeddings.create(model=self.model, input=texts[start:start + EMBEDDING_BATCH_SIZE])
+            vectors.extend(item.embedding for item in response.data)
+        return self.normalize(np.array(vectors, dtype=np.float32))
+
+    def _signature(self, texts: List[str]) -> str:
+        digest = hashlib.blake2b(self.model.encode(), digest_size=16)
+        for product, text in zip(self.products, texts):
+            digest.update(f"\x00{product.id}\x00{text}".encode())
+        return digest.hexdigest()
+
+    def build(self):
+        """Load or embed the product matrix now instead of on the first ranking"""
+        self._ensure_built()
+
+    def _ensure_built(self) -> np.ndarray:
+        """Load the product matrix from cache_path, or embed the catalog once"""
+        if self._matrix is not None:
+            return self._matrix
+
+        with self._lock:
+            if self._matrix is None:
+                texts = [self.product_text(p) for p in self.products]
+                signature = self._signature(texts)
+                matrix = None
+
+                if self.cache_path and os.path.exists(self.cache_path):
+                    matrix = self._load_cached(signature)
+
+                if matrix is None:
+                    matrix = self._embed(texts)
+                    if self.cache_path:
+                        self._save_cached(matrix, signature)
+
+                self._row_by_id = {p.id: i for i, p in enumerate(self.products)}
+                self._matrix = matrix
+        return self._matrix
+
+    def _load_cached(self, signature: str) -> Optional[np.ndarray]:
+        """Matrix stored at cache_path for this signature; None if stale or unreadable (re-embedded)"""
+        try:
+            with np.load(self.cache_path) as cached:
+                if str(cached['signature']) == signature:
+                    return cached['embeddings']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"Ignoring unreadable embedding cache {self.cache_path}: {e}")
+        return None
+
+    def _save_cached(self, matrix: np.ndarray, signature: str):
+        """
+        Write cache_path atomically: a temp file in the same directory replaces it,
+        so workers embedding concurrently never leave a half-written file behind
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)), suffix=".npz.tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, embeddings=matrix, signature=np.array(signature))
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Could not write embedding cache {self.cache_path}: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Normalized embedding of a query text (LRU-cached; the request is made outside the lock)"""
+        with self._query_cache_lock:
+            vector = self._query_cache.get(text)
+            if vector is not None:
+                self._query_cache.move_to_end(text)
+                return vector
+
+        vector = self._embed([text])[0]
+        with self._query_cache_lock:
+            self._query_cache[text] = vector
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return vector
+
+    def scores(self, candidates: List[Product], query_text: str) -> np.ndarray:
+        """Cosine similarity of each candidate to the query text"""
+        matrix = self._ensure_built()
+        rows = [self._row_by_id[p.id] for p in candidates]
+        return matrix[rows] @ self.embed_query(query_text)
@@ -3,11 +3,31 @@ Enhanced two-stage recommendation system:
 Stage 1: Progressive filtering to get 15 candidates
 Stage 2: LLM ranking to select top 5
 """
-from typing import List, Dict, Any, Union
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import numpy as np
 from .models import Product, AttributeFilter, PriceFilter
 from .catalog import ProductCatalog
 from .progressive_matcher import ProgressiveMatcher
 from .llm_ranker import LLMRanker
+from .embedding_index import ProductEmbeddingIndex
+
+
+# Stage 1 results remembered per matcher, keyed by the filtering inputs
+STAGE1_CACHE_SIZE = 128
+
+# Stage 1 log entries as recorded for the memo: (component, details)
+Stage1Logs = Tuple[Tuple[str, Dict[str, Any]], ...]
+
+
+def _as_tuple(values: Any) -> Any:
+    return tuple(values) if isinstance(values, list) else values
+
+
+def _as_list(values: Any) -> Any:
+    return list(values) if isinstance(values, tuple) else values
 
 
 class EnhancedProgressiveMatcher:
@@ -25,117 +45,309 @@ class EnhancedProgressiveMatcher:
         # Override progressive matcher settings for candidate generation
         self.progressive_matcher.target_count = self.candidate_count
         
+        # Memoized Stage 1 (per instance, so the cache goes away with the matcher):
+        # key -> (candidates, the filtering logs to replay on a hit), LRU order
+        self._stage1_cache: "OrderedDict[Tuple, Tuple[Tuple[Product, ...], Stage1Logs]]" = OrderedDict()
+        self._stage1_lock = threading.Lock()
+        
+        # Embedding pre-ranking that can settle the top 5 without the LLM
+        self.embedding_config = self.llm_ranker.config.get('embedding_ranking', {})
+        self.embedding_index = None
+        if self.embedding_config.get('enabled'):
+            self.embedding_index = ProductEmbeddingIndex(
+                catalog.products,
+                model=self.embedding_config['model'],
+                cache_path=self.embedding_config.get('cache_path')
+            )
+        
         # Logging callback for detailed logs
         self.log_callback = None
         self.session_id = None
     
-    def find_recommendations(self, conversation_attributes: Dict[str, Any]) -> List[Product]:
+    def find_recommendations(self, conversation_attributes: Dict[str, Any],
+                             log_callback: Optional[Callable] = None,
+                             session_id: Optional[str] = None) -> List[Product]:
         """
         Main method: Two-stage recommendation process
         
         Args:
             conversation_attributes: Output from conversation system with attributes,
                                    confidence_scores, and product_info
+            log_callback, session_id: Where this call's logs go (default: the
+                                      matcher's own log_callback/session_id). Passed
+                                      per call so concurrent sessions can share a matcher.
         
         Returns:
             Top 5 LLM-ranked products
         """
+        log = self._logger(log_callback, session_id)
+        candidates, settled = self._prepare_ranking(conversation_attributes, log_callback, session_id)
+        if settled is not None:
+            return settled
+        
+        # Stage 2: LLM intelligent ranking
+        try:
+            top_recommendations = self.llm_ranker.rank_candidates(
+                candidates, 
+                conversation_attributes,
+                log_callback=log_callback,
+                session_id=session_id
+            )
+        except Exception as e:
+            return self._ranking_failed(e, candidates, log)
+        return self._ranking_done(top_recommendations, log)
+    
+    async def find_recommendations_async(self, conversation_attributes: Dict[str, Any],
+                                         log_callback: Optional[Callable] = None,
+                                         session_id: Optional[str] = None) -> List[Product]:
+        """
+        Async find_recommendations: filtering and embedding similarity run in a worker
+        thread, the LLM ranking on the shared AsyncOpenAI client (coalesced per loop)
+        """
+        log = self._logger(log_callback, session_id)
+        candidates, settled = await asyncio.to_thread(
+            self._prepare_ranking, conversation_attributes, log_callback, session_id
+        )
+        if settled is not None:
+            return settled
+        
+        try:
+            top_recommendations = await self.llm_ranker.rank_candidates_async(
+                candidates,
+                conversation_attributes,
+                log_callback=log_callback,
+                session_id=session_id
+            )
+        except Exception as e:
+            return self._ranking_failed(e, candidates, log)
+        return self._ranking_done(top_recommendations, log)
+    
+    def _logger(self, log_callback: Optional[Callable],
+                session_id: Optional[str]) -> Callable[[str, Dict[str, Any]], None]:
+        """Log sink for one recommendation run (default: the matcher's own callback and session)"""
+        log_callback = log_callback or self.log_callback
+        session_id = session_id or self.session_id
+        
+        def log(component: str, details: Dict[str, Any]):
+            if log_callback and session_id:
+                log_callback(session_id, component, details)
+        return log
+    
+    def _prepare_ranking(self, conversation_attributes: Dict[str, Any], log_callback: Optional[Callable],
+                         session_id: Optional[str]) -> Tuple[List[Product], Optional[List[Product]]]:
+        """
+        Stage 1 plus the Stage 2 shortcuts that need no LLM ranking (blocking).
+        Returns (candidates, final recommendations or None when the LLM should rank).
+        """
+        log = self._logger(log_callback, session_id)
+        
         # Log Stage 1 initiation
-        if self.log_callback and self.session_id:
-            self.log_callback(self.session_id, "recommendation_stage1", {
-                "stage": "Stage 1: Progressive Filtering",
-                "target_candidates": self.candidate_count,
-                "filters_to_apply": list(conversation_attributes.get('attributes', {}).keys())
-            })
+        log("recommendation_stage1", {
+            "stage": "Stage 1: Progressive Filtering",
+            "target_candidates": self.candidate_count,
+            "filters_to_apply": list(conversation_attributes.get('attributes', {}).keys())
+        })
         
         print(f"🎯 ENHANCED RECOMMENDATION SYSTEM")
         print(f"Stage 1: Finding {self.candidate_count} candidates...")
         
-        # Pass logging info to progressive matcher
-        if hasattr(self.progressive_matcher, 'log_callback'):
-            self.progressive_matcher.log_callback = self.log_callback
-            self.progressive_matcher.session_id = self.session_id
-        
         # Stage 1: Get diverse candidate pool using progressive filtering
-        candidates = self.progressive_matcher.find_recommendations(conversation_attributes)
+        candidates = self.find_candidates(conversation_attributes, log_callback, session_id)
         
         # Log Stage 1 completion
-        if self.log_callback and self.session_id:
-            self.log_callback(self.session_id, "recommendation_stage1", {
-                "stage": "Stage 1 Complete",
-                "candidates_found": len(candidates),
-                "proceeding_to_stage2": len(candidates) > 5
-            })
+        log("recommendation_stage1", {
+            "stage": "Stage 1 Complete",
+            "candidates_found": len(candidates),
+            "proceeding_to_stage2": len(candidates) > self.final_count
+        })
         
         print(f"✅ Stage 1 complete: Found {len(candidates)} candidates")
         
-        # If we have 5 or fewer candidates, skip LLM ranking
-        if len(candidates) <= 5:
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "Stage 2 Skipped",
-                    "reason": f"Only {len(candidates)} candidates found",
-                    "final_count": len(candidates)
-                })
+        # If Stage 1 already returned no more than the final count, skip ranking
+        if len(candidates) <= self.final_count:
+            log("recommendation_stage2", {
+                "stage": "Stage 2 Skipped",
+                "reason": f"Only {len(candidates)} candidates found",
+                "final_count": len(candidates)
+            })
             print(f"⚡ Skipping LLM ranking (only {len(candidates)} candidates)")
-            return candidates
+            return candidates, candidates
         
         # Log Stage 2 initiation
-        if self.log_callback and self.session_id:
-            self.log_callback(self.session_id, "recommendation_stage2", {
-                "stage": "Stage 2: LLM Ranking",
-                "candidates_to_rank": len(candidates),
-                "target_final_count": self.final_count
+        log("recommendation_stage2", {
+            "stage": "Stage 2: LLM Ranking",
+            "candidates_to_rank": len(candidates),
+            "target_final_count": self.final_count
+        })
+        
+        # A ranking already cached for these candidates makes the embedding round-trip moot
+        if self.embedding_index is not None:
+            cached = self.llm_ranker.cached_ranking(candidates, conversation_attributes, log_callback, session_id)
+            if cached is not None:
+                return candidates, self._ranking_done(cached, log)
+        
+        # Stage 2a: Embedding similarity; a clear top 5 needs no LLM ranking
+        top_by_similarity = self._rank_by_embedding(candidates, conversation_attributes)
+        if top_by_similarity is not None:
+            log("recommendation_stage2", {
+                "stage": "Stage 2 Complete (Embedding Similarity)",
+                "final_count": len(top_by_similarity),
+                "llm_ranking_skipped": True
             })
+            print(f"✅ Stage 2 complete: Top {len(top_by_similarity)} clearly ahead by similarity, skipping LLM ranking")
+            return candidates, top_by_similarity
         
         print(f"🧠 Stage 2: LLM ranking {len(candidates)} candidates to top {self.final_count}...")
+        return candidates, None
+    
+    def _ranking_done(self, top_recommendations: List[Product],
+                      log: Callable[[str, Dict[str, Any]], None]) -> List[Product]:
+        """Log and display a completed Stage 2 ranking"""
+        # Log Stage 2 completion
+        log("recommendation_stage2", {
+            "stage": "Stage 2 Complete",
+            "final_count": len(top_recommendations),
+            "llm_ranking_success": True
+        })
         
-        # Pass logging info to LLM ranker
-        if hasattr(self.llm_ranker, 'log_callback'):
-            self.llm_ranker.log_callback = self.log_callback
-            self.llm_ranker.session_id = self.session_id
+        print(f"✅ Stage 2 complete: Selected top {len(top_recommendations)} recommendations")
         
-        # Stage 2: LLM intelligent ranking
+        # Display ranking results if available
+        self._display_ranking_results(top_recommendations)
+        
+        return top_recommendations
+    
+    def _ranking_failed(self, error: Exception, candidates: List[Product],
+                        log: Callable[[str, Dict[str, Any]], None]) -> List[Product]:
+        """Log a Stage 2 failure and fall back to the first candidates"""
+        # Log Stage 2 failure
+        log("recommendation_stage2", {
+            "stage": "Stage 2 Failed",
+            "error": str(error),
+            "fallback_count": min(self.final_count, len(candidates))
+        })
+        
+        print(f"❌ LLM ranking failed: {error}")
+        print(f"🔄 Fallback: Returning first {self.final_count} candidates")
+        return candidates[:self.final_count]
+    
+    def warm_up(self):
+        """Build the product embedding index ahead of the first request (blocking)"""
+        if self.embedding_index is not None:
+            self.embedding_index.build()
+    
+    @staticmethod
+    def _stage1_key(conversation_attributes: Dict[str, Any]) -> Tuple:
+        """Hashable form of the inputs Stage 1 filters on"""
+        attributes = conversation_attributes.get('attributes', {})
+        confidences = conversation_attributes.get('confidence_scores', {})
+        price_range = conversation_attributes.get('product_info', {}).get('price_range')
+        return (
+            tuple((name, _as_tuple(values)) for name, values in attributes.items()),
+            tuple((name, _as_tuple(scores)) for name, scores in confidences.items()),
+            tuple(price_range.items()) if price_range else None
+        )
+    
+    def _run_stage1(self, key: Tuple) -> Tuple[Tuple[Product, ...], Stage1Logs]:
+        """Filter for a Stage 1 key, recording the filtering logs instead of sending them"""
+        attributes, confidences, price_range = key
+        stage1_input = {
+            'attributes': {name: _as_list(values) for name, values in attributes},
+            'confidence_scores': {name: _as_list(scores) for name, scores in confidences},
+            'product_info': {'price_range': dict(price_range)} if price_range else {}
+        }
+        logs = []
+        products = self.progressive_matcher.find_recommendations(
+            stage1_input,
+            log_callback=lambda _session_id, component, details: logs.append((component, details)),
+            session_id="stage1-memo"
+        )
+        return tuple(products), tuple(logs)
+    
+    def find_candidates(self, conversation_attributes: Dict[str, Any],
+                        log_callback: Optional[Callable] = None,
+                        session_id: Optional[str] = None) -> List[Product]:
+        """
+        Stage 1 candidates, reused when the same attributes were filtered before.
+        The filtering logs are replayed to log_callback on every call, memoized or not.
+        """
+        log_callback = log_callback or self.log_callback
+        session_id = session_id or self.session_id
         try:
-            top_recommendations = self.llm_ranker.rank_candidates(
-                candidates, 
-                conversation_attributes
-            )
-            
-            # Log Stage 2 completion
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "Stage 2 Complete",
-                    "final_count": len(top_recommendations),
-                    "llm_ranking_success": True
+            key = self._stage1_key(conversation_attributes)
+            hash(key)
+        except TypeError:
+            # Unexpected attribute shapes: filter without memoizing
+            return self.progressive_matcher.find_recommendations(conversation_attributes, log_callback, session_id)
+        
+        with self._stage1_lock:
+            cached = self._stage1_cache.get(key)
+            if cached is not None:
+                self._stage1_cache.move_to_end(key)
+        hit = cached is not None
+        if not hit:
+            # Filtering is cheap; concurrent misses for one key may both run it
+            cached = self._run_stage1(key)
+            with self._stage1_lock:
+                self._stage1_cache[key] = cached
+                if len(self._stage1_cache) > STAGE1_CACHE_SIZE:
+                    self._stage1_cache.popitem(last=False)
+        
+        products, logs = cached
+        if log_callback and session_id:
+            if hit:
+                log_callback(session_id, "recommendation_stage1", {
+                    "stage": "Stage 1 Cache Hit",
+                    "memoized_candidates": len(products)
                 })
-            
-            print(f"✅ Stage 2 complete: Selected top {len(top_recommendations)} recommendations")
-            
-            # Display ranking results if available
-            self._display_ranking_results(top_recommendations)
-            
-            return top_recommendations
-            
+            for component, details in logs:
+                log_callback(session_id, component, details)
+        return list(products)
+    
+    def clear_candidate_cache(self):
+        """Forget memoized Stage 1 results (call after the catalog is reloaded)"""
+        with self._stage1_lock:
+            self._stage1_cache.clear()
+    
+    @staticmethod
+    def _similarity_query_text(conversation_attributes: Dict[str, Any]) -> str:
+        """Text describing what the shopper wants, embedded against product texts"""
+        parts = [conversation_attributes.get('original_query', '')]
+        for attr_name, values in conversation_attributes.get('attributes', {}).items():
+            if values:
+                parts.append(f"{attr_name}: {', '.join(str(v) for v in values)}")
+        return " | ".join(part for part in parts if part)
+    
+    def _rank_by_embedding(self, candidates: List[Product],
+                           conversation_attributes: Dict[str, Any]) -> Optional[List[Product]]:
+        """
+        Top candidates by cosine similarity when they stand out from the rest by at
+        least the configured margin; None when the LLM should decide
+        """
+        if self.embedding_index is None or len(candidates) <= self.final_count:
+            return None
+        
+        try:
+            scores = self.embedding_index.scores(candidates, self._similarity_query_text(conversation_attributes))
         except Exception as e:
-            # Log Stage 2 failure
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "Stage 2 Failed",
-                    "error": str(e),
-                    "fallback_count": min(self.final_count, len(candidates))
-                })
-            
-            print(f"❌ LLM ranking failed: {e}")
-            print(f"🔄 Fallback: Returning first {self.final_count} candidates")
-            return candidates[:self.final_count]
+            print(f"Embedding ranking unavailable: {e}")
+            return None
+        
+        # Unordered top-k partition, then order just those k
+        top = np.argpartition(scores, -self.final_count)[-self.final_count:]
+        top = top[np.argsort(scores[top])[::-1]]
+        runner_up = np.max(np.delete(scores, top))
+        if scores[top[-1]] - runner_up < self.embedding_config['skip_llm_margin']:
+            return None
+        
+        return [candidates[index].with_ranking(round(float(scores[index]) * 100, 1)) for index in top]
     
     def _display_ranking_results(self, ranked_products: List[Product]):
         """Display LLM ranking results for debugging"""
         print(f"\n🏆 LLM RANKING RESULTS:")
         for i, product in enumerate(ranked_products, 1):
-            score = getattr(product, 'ranking_score', 'N/A')
-            reasoning = getattr(product, 'ranking_reasoning', 'No reasoning provided')
+            score = product.ranking_score if product.ranking_score is not None else 'N/A'
+            reasoning = product.ranking_reasoning or 'No reasoning provided'
             print(f"{i}. {product.name} - ${product.price} (Score: {score})")
             print(f"   Reasoning: {reasoning}")
             print()
@@ -145,7 +357,7 @@ class EnhancedProgressiveMatcher:
         Get detailed information about the candidate selection process
         Useful for debugging and analysis
         """
-        candidates = self.progressive_matcher.find_recommendations(conversation_attributes)
+        candidates = self.find_candidates(conversation_attributes)
         
         return {
             'total_candidates': len(candidates),
@@ -220,8 +432,8 @@ class HybridMatcher:
                     'name': p.name, 
                     'price': p.price, 
                     'category': p.category,
-                    'ranking_score': getattr(p, 'ranking_score', 'N/A'),
-                    'reasoning': getattr(p, 'ranking_reasoning', 'N/A')
+                    'ranking_score': p.ranking_score if p.ranking_score is not None else 'N/A',
+                    'reasoning': p.ranking_reasoning or 'N/A'
                 }
                 for p in enhanced_results
             ]
@@ -1,11 +1,111 @@
 """
 LLM-powered intelligent ranking for product recommendations
 """
+import asyncio
+import concurrent.futures
+import hashlib
 import json
 import os
-from typing import List, Dict, Any, Tuple
-import openai
-from .models import Product
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from common import serialization
+from common.config import load_config
+from common.semantic_cache import SemanticCache
+from common.clients import get_async_openai, get_openai
+from .models import Product, PROMPT_LINE_COLUMNS
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+
+# Sends one Stage 2 log entry; the payload function is only called when a logger is attached
+StageLog = Callable[[Callable[[], Dict[str, Any]]], None]
+
+# Bumped whenever the cached ranking result format changes
+# (3: full rankings again; version 2 entries may hold streams truncated after 5 entries)
+RANKING_FORMAT_VERSION = 3
+
+
+def ranking_schema(include_reasoning: bool = False) -> Dict[str, Any]:
+    """Strict JSON schema for the ranking response: candidate ids with scores, best first"""
+    item_properties = {
+        "id": {"type": "string"},
+        "score": {"type": "number"}
+    }
+    properties = {
+        "rankings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": item_properties,
+                "required": list(item_properties),
+                "additionalProperties": False
+            }
+        }
+    }
+    if include_reasoning:
+        item_properties["reasoning"] = {"type": "string"}
+        properties["overall_reasoning"] = {"type": "string"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+# Static instructions and rubric, sent as the system message so the shared prefix
+# can be prompt-cached; each request only carries the customer context and candidates
+RANKING_SYSTEM_PROMPT = """You are an expert fashion stylist ranking candidate products for a customer. Respond with valid JSON only.
+
+Score every candidate 0-100 on:
+- Relevance (40%): match with the stated preferences
+- Style coherence (25%): fit with the vibe/occasion of the request
+- Value (20%): price appropriate for what they want and their budget
+- Variety (15%): the top 5 together should offer diverse options
+
+Return every candidate's id with its score, best match first."""
+
+RANKING_REASONING_INSTRUCTIONS = " Add a one-sentence reason per product and a brief overall selection strategy."
+
+# Product attributes that are plain filters; when the user only stated these, the
+# order of the (few) candidates does not need a style judgement
+HEURISTIC_ATTRIBUTES = frozenset([
+    'category', 'sizes', 'fit', 'color_or_print', 'fabric',
+    'sleeve_length', 'neckline', 'length', 'pant_type'
+])
+
+# Query words that ask for taste rather than filtering; any of them sends the ranking to the LLM
+STYLE_WORDS = frozenset([
+    'vibe', 'vibes', 'style', 'stylish', 'look', 'looks', 'aesthetic', 'elegant', 'chic',
+    'classy', 'trendy', 'cute', 'boho', 'edgy', 'minimal', 'minimalist', 'vintage', 'retro',
+    'sexy', 'flattering', 'fancy', 'cozy', 'sophisticated', 'glam', 'preppy', 'romantic',
+    'date', 'party', 'wedding', 'brunch', 'vacation', 'office', 'festival', 'night', 'occasion'
+])
+
+# Heuristic score weights: within budget, share of stated attributes matched, cheapness
+HEURISTIC_WEIGHTS = (0.3, 0.5, 0.2)
+
+# Recent conversation included in ranking prompts, in characters (~150 tokens)
+HISTORY_CHAR_BUDGET = 600
+HISTORY_SEPARATOR = " / "
+
+# Per-request user message; only the placeholders change between calls
+RANKING_PROMPT_TEMPLATE = """Request: "{query}"
+Preferences: {attributes}
+Budget: {budget}
+Recent conversation: {history}
+
+Candidates (""" + PROMPT_LINE_COLUMNS + """):
+{candidates}"""
 
 
 class LLMRanker:
@@ -13,120 +113,533 @@ class LLMRanker:
     
     def __init__(self, config_file: str = "data/config.json"):
         """Initialize the LLM ranker"""
-        # Load configuration
-        with open(config_file, 'r') as f:
-            self.config = json.load(f)
+        # Load configuration (parsed once per path and shared by all rankers)
+        self.config = load_config(config_file)
+        
+        # Shared OpenAI clients (pooled connections reused across rankers and sessions).
+        # The SDK retries rate limits, timeouts and 5xx responses with exponential backoff.
+        max_retries = self.config.get('processing', {}).get('max_retries', 2)
+        self.client = get_openai().with_options(max_retries=max_retries)
+        self.aclient = get_async_openai().with_options(max_retries=max_retries)
+        self._llm_semaphore = asyncio.Semaphore(self.config['openai'].get('max_concurrency', 8))
+        
+        # Per-product reasoning costs most of the output tokens; only requested for debugging
+        self.ranking_config = self.config.get('ranking', {})
+        self.include_reasoning = self.ranking_config.get('include_reasoning', False)
+        self.system_prompt = RANKING_SYSTEM_PROMPT + (RANKING_REASONING_INSTRUCTIONS if self.include_reasoning else "")
+        self.response_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "product_ranking",
+                "strict": True,
+                "schema": ranking_schema(self.include_reasoning)
+            }
+        }
+        
+        # Ranking cache: in-process LRU (L1) backed by Redis (L2) when REDIS_URL is set,
+        # otherwise by an on-disk cache that survives restarts
+        self.ranking_cache_config = self.config.get('ranking_cache', {})
+        self._ranking_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._ranking_cache_lock = threading.Lock()  # Rankings run on several worker threads
+        self._redis = None
+        self._disk_cache = None
+        self._disk_cache_pid = None
+        redis_url = os.getenv('REDIS_URL')
+        if self.ranking_cache_config.get('enabled') and redis_url and REDIS_AVAILABLE:
+            self._redis = redis.Redis.from_url(redis_url)
+        
+        # Semantic layer: same candidates and budget, similar query + preferences
+        self.semantic_rank_cache = None
+        if self.ranking_cache_config.get('enabled') and self.ranking_cache_config.get('semantic_enabled'):
+            self.semantic_rank_cache = SemanticCache(
+                threshold=self.ranking_cache_config['similarity_threshold'],
+                max_entries_per_bucket=self.ranking_cache_config['max_entries_per_bucket'],
+                ttl_seconds=self.ranking_cache_config['ttl_seconds']
+            )
         
-        # Initialize OpenAI client
-        self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Ranking requests in flight, by cache key (see _coalesced)
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+        self._inflight_lock = threading.Lock()
+        self._inflight_async: Dict[str, asyncio.Future] = {}
+        
+        # Jobs of submitted Batch API rankings, by batch id (see submit_ranking_batch)
+        self._batch_jobs: Dict[str, Dict[str, Tuple[List[Product], Dict[str, Any]]]] = {}
         
         # Logging callback for detailed logs
         self.log_callback = None
         self.session_id = None
     
-    def rank_candidates(self, candidates: List[Product], conversation_context: Dict[str, Any]) -> List[Product]:
+    def rank_candidates(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                        log_callback: Optional[Callable] = None,
+                        session_id: Optional[str] = None) -> List[Product]:
         """
         Use LLM to intelligently rank candidates and return top 5
         
         Args:
             candidates: List of candidate products (up to 15)
             conversation_context: Full conversation context including attributes, history, etc.
+            log_callback, session_id: Where this call's logs go (default: the
+                                      ranker's own log_callback/session_id)
         
         Returns:
             Top 5 ranked products
         """
+        log = self._logger(log_callback, session_id)
+        if not self._should_rank(candidates, conversation_context, log):
+            return candidates
+        
+        if self._can_skip_llm(candidates, conversation_context):
+            return self._heuristic_ranking(candidates, conversation_context, log)
+        
+        try:
+            # Identical requests already in flight on other threads share one result
+            cache_key = self._ranking_cache_key(candidates, conversation_context)
+            ranking_result = self._coalesced(
+                cache_key, lambda: self._obtain_ranking(candidates, conversation_context, cache_key, log)
+            )
+            return self._finish_ranking(ranking_result, candidates, log)
+            
+        except Exception as e:
+            return self._ranking_failed(e, candidates, log)
+    
+    async def rank_candidates_async(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                                    log_callback: Optional[Callable] = None,
+                                    session_id: Optional[str] = None) -> List[Product]:
+        """
+        Async rank_candidates: the LLM call goes through the shared AsyncOpenAI client,
+        so rankings for several sessions can run concurrently (e.g. with asyncio.gather)
+        """
+        log = self._logger(log_callback, session_id)
+        if not self._should_rank(candidates, conversation_context, log):
+            return candidates
+        
+        if self._can_skip_llm(candidates, conversation_context):
+            return self._heuristic_ranking(candidates, conversation_context, log)
+        
+        try:
+            # Identical requests already in flight on this loop share one result
+            cache_key = self._ranking_cache_key(candidates, conversation_context)
+            ranking_result = await self._coalesced_async(
+                cache_key, lambda: self._obtain_ranking_async(candidates, conversation_context, cache_key, log)
+            )
+            return self._finish_ranking(ranking_result, candidates, log)
+            
+        except Exception as e:
+            return self._ranking_failed(e, candidates, log)
+    
+    def cached_ranking(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                       log_callback: Optional[Callable] = None,
+                       session_id: Optional[str] = None) -> Optional[List[Product]]:
+        """
+        Top 5 from a ranking cached for exactly these candidates and preferences
+        (in-process, Redis or disk; no embedding or LLM request), or None
+        """
+        if len(candidates) <= 5 or not self.ranking_cache_config.get('enabled'):
+            return None
+        ranking_result = self._get_cached_ranking(self._ranking_cache_key(candidates, conversation_context))
+        if ranking_result is None:
+            return None
+        
+        log = self._logger(log_callback, session_id)
+        log(lambda: {
+            "stage": "LLM Ranking Cache Hit",
+            "candidate_count": len(candidates)
+        })
+        return self._finish_ranking(ranking_result, candidates, log)
+    
+    def _obtain_ranking(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                        cache_key: str, log: StageLog) -> Dict[str, Any]:
+        """Cached ranking result, or a fresh one from the LLM (then cached)"""
+        ranking_result, pending = self._lookup_ranking(candidates, conversation_context, cache_key, log)
+        if ranking_result is None:
+            # Get LLM ranking
+            prompt, model = self._prepare_llm_call(candidates, conversation_context, log)
+            ranking_result = self._call_llm_for_ranking(prompt, model)
+            self._store_rankings(pending, ranking_result)
+        return ranking_result
+    
+    async def _obtain_ranking_async(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                                    cache_key: str, log: StageLog) -> Dict[str, Any]:
+        """Async _obtain_ranking"""
+        # Cache lookups (Redis, query embedding) are blocking; keep them off the loop
+        ranking_result, pending = await asyncio.to_thread(
+            self._lookup_ranking, candidates, conversation_context, cache_key, log
+        )
+        if ranking_result is None:
+            prompt, model = self._prepare_llm_call(candidates, conversation_context, log)
+            ranking_result = await self._call_llm_for_ranking_async(prompt, model)
+            await asyncio.to_thread(self._store_rankings, pending, ranking_result)
+        return ranking_result
+    
+    def _coalesced(self, key: str, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Single-flight: the first caller for a key computes, concurrent callers wait for its result"""
+        with self._inflight_lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = concurrent.futures.Future()
+        if not leader:
+            return flight.result()
+        
+        try:
+            flight.set_result(compute())
+        except Exception as e:
+            flight.set_exception(e)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+        return flight.result()
+    
+    async def _coalesced_async(self, key: str,
+                               compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Async single-flight over futures of the running loop. If the leading call
+        fails, its flight is cancelled and the waiting callers start a new one.
+        """
+        flight = self._inflight_async.get(key)
+        if flight is not None:
+            try:
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise  # This caller itself was cancelled
+                # The leader failed: the first waiter to resume leads a retry
+                return await self._coalesced_async(key, compute)
+        
+        flight = self._inflight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            ranking_result = await compute()
+        except BaseException:
+            flight.cancel()
+            raise
+        finally:
+            del self._inflight_async[key]
+        flight.set_result(ranking_result)
+        return ranking_result
+    
+    def _logger(self, log_callback: Optional[Callable], session_id: Optional[str]) -> StageLog:
+        """Stage 2 log sink for one ranking call (default: the ranker's own callback and session)"""
+        log_callback = log_callback or self.log_callback
+        session_id = session_id or self.session_id
+        if log_callback is None or session_id is None:
+            return lambda payload_fn: None
+        return lambda payload_fn: log_callback(session_id, "recommendation_stage2", payload_fn())
+    
+    def _should_rank(self, candidates: List[Product], conversation_context: Dict[str, Any], log: StageLog) -> bool:
+        """Log the start of ranking; False when there are too few candidates to rank"""
         # Log Stage 2 initiation
-        if self.log_callback and self.session_id:
-            self.log_callback(self.session_id, "recommendation_stage2", {
-                "stage": "LLM Ranking Started",
-                "candidates_to_rank": len(candidates),
-                "ranking_criteria": ["relevance", "style_coherence", "value", "variety"]
-            })
+        log(lambda: {
+            "stage": "LLM Ranking Started",
+            "candidates_to_rank": len(candidates),
+            "ranking_criteria": ["relevance", "style_coherence", "value", "variety"]
+        })
         
         if len(candidates) <= 5:
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "LLM Ranking Skipped",
-                    "reason": "5 or fewer candidates",
-                    "returning_all": len(candidates)
-                })
-            return candidates
+            log(lambda: {
+                "stage": "LLM Ranking Skipped",
+                "reason": "5 or fewer candidates",
+                "returning_all": len(candidates)
+            })
+            return False
         
         # Log prompt preparation
-        if self.log_callback and self.session_id:
-            original_query = conversation_context.get('original_query', '')
-            attributes = conversation_context.get('attributes', {})
-            self.log_callback(self.session_id, "recommendation_stage2", {
-                "stage": "Building LLM Prompt",
-                "original_query": original_query,
-                "user_attributes": list(attributes.keys()),
+        log(lambda: {
+            "stage": "Building LLM Prompt",
+            "original_query": conversation_context.get('original_query', ''),
+            "user_attributes": list(conversation_context.get('attributes', {}).keys()),
+            "candidate_count": len(candidates)
+        })
+        return True
+    
+    def _can_skip_llm(self, candidates: List[Product], context: Dict[str, Any]) -> bool:
+        """
+        True when ranking is really a filter problem: few candidates, only concrete
+        attribute filters and no style words in the query
+        """
+        if not self.ranking_config.get('heuristic_enabled', True):
+            return False
+        if len(candidates) > self.ranking_config.get('heuristic_max_candidates', 8):
+            return False
+        
+        attributes = context.get('attributes', {})
+        if not attributes or not HEURISTIC_ATTRIBUTES.issuperset(attributes):
+            return False
+        
+        query_words = context.get('original_query', '').lower().replace('-', ' ').split()
+        return not any(word.strip('.,!?"\'') in STYLE_WORDS for word in query_words)
+    
+    @staticmethod
+    def _attribute_match(product: Product, attributes: Dict[str, Any]) -> float:
+        """Share of the stated attributes the product satisfies"""
+        matched = 0
+        for name, values in attributes.items():
+            values = values if isinstance(values, list) else [values]
+            if name == 'sizes':
+                matched += any(product.matches_size(size) for size in values)
+            else:
+                matched += getattr(product, name, None) in values
+        return matched / len(attributes)
+    
+    def _heuristic_ranking(self, candidates: List[Product], context: Dict[str, Any], log: StageLog) -> List[Product]:
+        """Deterministic top 5 by budget fit, attribute match and price (no LLM call)"""
+        attributes = context.get('attributes', {})
+        price_info = context.get('product_info', {}).get('price_range') or {}
+        min_price, max_price = price_info.get('min_price'), price_info.get('max_price')
+        cheapest = min((p.price for p in candidates if p.price > 0), default=0)
+        w_price, w_attributes, w_cheap = HEURISTIC_WEIGHTS
+        
+        rankings = []
+        for product in candidates:
+            price_fit = float(product.matches_price_range(min_price, max_price))
+            cheapness = cheapest / product.price if product.price > 0 else 1.0
+            score = w_price * price_fit + w_attributes * self._attribute_match(product, attributes) + w_cheap * cheapness
+            rankings.append({"id": product.id, "score": round(100 * score, 1)})
+        
+        ranked_products = self._parse_ranking_result({"rankings": rankings}, candidates)
+        
+        log(lambda: {
+            "stage": "Heuristic Ranking Used",
+            "reason": "few candidates and only concrete attribute filters",
+            "final_recommendations": len(ranked_products),
+            "product_rankings": self._ranking_details(ranked_products)
+        })
+        return ranked_products
+    
+    def _lookup_ranking(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                        cache_key: str, log: StageLog) -> Tuple[Optional[Dict[str, Any]], Tuple]:
+        """
+        Cached ranking for these candidates (exact, then semantic), or None.
+        Also returns the cache keys needed to store a fresh result.
+        """
+        # Reuse a cached ranking of the same candidates for the same preferences
+        ranking_result = self._get_cached_ranking(cache_key)
+        semantic_bucket, embedding = None, None
+        if ranking_result is None:
+            ranking_result, semantic_bucket, embedding = self._lookup_similar_ranking(
+                candidates, conversation_context
+            )
+        
+        if ranking_result is not None:
+            log(lambda: {
+                "stage": "LLM Ranking Cache Hit",
                 "candidate_count": len(candidates)
             })
-        
+        return ranking_result, (cache_key, semantic_bucket, embedding)
+    
+    def _store_rankings(self, pending: Tuple, ranking_result: Dict[str, Any]):
+        """Store a fresh LLM ranking under the keys returned by _lookup_ranking"""
+        cache_key, semantic_bucket, embedding = pending
+        self._store_ranking(cache_key, ranking_result)
+        if embedding is not None:
+            self.semantic_rank_cache.add(semantic_bucket, embedding, ranking_result)
+    
+    def _ranking_model(self, candidates: List[Product], conversation_context: Dict[str, Any]) -> str:
+        """
+        Model for a ranking request: the small model when there is little to weigh
+        (few candidates, few stated preferences), the configured model otherwise
+        """
+        complexity = len(candidates) * (1 + len(conversation_context.get('attributes', {})))
+        small_model = self.ranking_config.get('model_small')
+        if small_model and complexity < self.ranking_config.get('small_model_max_complexity', 0):
+            return small_model
+        return self.config['openai']['model']
+    
+    def _prepare_llm_call(self, candidates: List[Product], conversation_context: Dict[str, Any],
+                          log: StageLog) -> Tuple[str, str]:
+        """Build the ranking prompt, pick the model and log the upcoming LLM call"""
         # Prepare data for LLM
         prompt = self._build_ranking_prompt(candidates, conversation_context)
+        model = self._ranking_model(candidates, conversation_context)
+        
+        # Log LLM call
+        log(lambda: {
+            "stage": "Calling LLM for Ranking",
+            "model": model,
+            "temperature": 0.3
+        })
+        return prompt, model
+    
+    @staticmethod
+    def _ranking_details(ranked_products: List[Product]) -> List[Dict[str, Any]]:
+        """Log summary of the top 5 ranked products"""
+        product_details = []
+        for i, product in enumerate(ranked_products[:5], 1):
+            score = product.ranking_score if product.ranking_score is not None else 'N/A'
+            reasoning = product.ranking_reasoning or 'No reasoning'
+            product_details.append({
+                "rank": i,
+                "name": product.name,
+                "price": product.price,
+                "score": score,
+                "reasoning": reasoning[:100] + "..." if len(reasoning) > 100 else reasoning
+            })
+        return product_details
+    
+    def _finish_ranking(self, ranking_result: Dict[str, Any], candidates: List[Product],
+                        log: StageLog) -> List[Product]:
+        """Apply a ranking result to the candidates and return the top 5"""
+        # Log LLM response
+        log(lambda: {
+            "stage": "LLM Ranking Response",
+            "overall_reasoning": ranking_result.get('overall_reasoning', 'No reasoning provided'),
+            "top_selections": len(ranking_result.get('rankings', []))
+        })
+        
+        # Parse and return the top 5 ranked products
+        ranked_products = self._parse_ranking_result(ranking_result, candidates)
+        
+        # Log final ranking results
+        log(lambda: {
+            "stage": "LLM Ranking Complete",
+            "final_recommendations": len(ranked_products),
+            "product_rankings": self._ranking_details(ranked_products)
+        })
+        
+        return ranked_products
+    
+    def _ranking_failed(self, error: Exception, candidates: List[Product], log: StageLog) -> List[Product]:
+        """Log a ranking failure and fall back to the first 5 candidates"""
+        # Log ranking failure
+        log(lambda: {
+            "stage": "LLM Ranking Failed",
+            "error": str(error),
+            "fallback_count": min(5, len(candidates))
+        })
+        
+        print(f"LLM ranking error: {error}")
+        # Fallback: return first 5 candidates
+        return candidates[:5]
+    
+    def _ranking_cache_key(self, candidates: List[Product], context: Dict[str, Any]) -> str:
+        """
+        Content hash of what the ranking depends on: the candidate ids in prompt order
+        (the LLM answers by id, but the order can sway its scores and unranked candidates
+        are filled in that order) plus the query, preferences and budget.
+        Recent conversation only flavors the prompt and is left out so refinements hit.
+        """
+        payload = {
+            # Entries written in an older result format (e.g. by product number) never match
+            "format": [RANKING_FORMAT_VERSION, self.include_reasoning],
+            "ids": [product.id for product in candidates],
+            "query": context.get('original_query', ''),
+            "attributes": context.get('attributes', {}),
+            "price_range": context.get('product_info', {}).get('price_range', {})
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+    
+    def _get_disk_cache(self):
+        """On-disk L2 cache, opened lazily in the process using it (SQLite handles don't survive fork)"""
+        cache_dir = self.ranking_cache_config.get('disk_cache_dir')
+        if self._redis is not None or not cache_dir or not DISKCACHE_AVAILABLE:
+            return None
+        if self._disk_cache is None or self._disk_cache_pid != os.getpid():
+            self._disk_cache = diskcache.Cache(
+                cache_dir, size_limit=self.ranking_cache_config.get('disk_size_limit', 2 ** 30)
+            )
+            self._disk_cache_pid = os.getpid()
+        return self._disk_cache
+    
+    def _get_cached_ranking(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Look up a ranking result in the in-process cache, then Redis or the disk cache"""
+        if not self.ranking_cache_config.get('enabled'):
+            return None
         
+        with self._ranking_cache_lock:
+            ranking_result = self._ranking_cache.get(cache_key)
+            if ranking_result is not None:
+                self._ranking_cache.move_to_end(cache_key)
+        if ranking_result is not None:
+            return ranking_result
+        
+        cached = None
         try:
-            # Log LLM call
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "Calling LLM for Ranking",
-                    "model": self.config['openai']['model'],
-                    "temperature": 0.3
-                })
-            
-            # Get LLM ranking
-            ranking_result = self._call_llm_for_ranking(prompt)
-            
-            # Log LLM response
-            if self.log_callback and self.session_id:
-                overall_reasoning = ranking_result.get('overall_reasoning', 'No reasoning provided')
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "LLM Ranking Response",
-                    "overall_reasoning": overall_reasoning,
-                    "top_selections": len(ranking_result.get('top_5', []))
-                })
-            
-            # Parse and return ranked products
-            ranked_products = self._parse_ranking_result(ranking_result, candidates)
-            
-            # Log final ranking results
-            if self.log_callback and self.session_id:
-                product_details = []
-                for i, product in enumerate(ranked_products[:5], 1):
-                    score = getattr(product, 'ranking_score', 'N/A')
-                    reasoning = getattr(product, 'ranking_reasoning', 'No reasoning')
-                    product_details.append({
-                        "rank": i,
-                        "name": product.name,
-                        "price": product.price,
-                        "score": score,
-                        "reasoning": reasoning[:100] + "..." if len(reasoning) > 100 else reasoning
-                    })
-                
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "LLM Ranking Complete",
-                    "final_recommendations": len(ranked_products),
-                    "product_rankings": product_details
-                })
-            
-            return ranked_products[:5]
-            
+            if self._redis is not None:
+                cached = self._redis.get(f"rank:{cache_key}")
+            elif self._get_disk_cache() is not None:
+                cached = self._disk_cache.get(f"rank:{cache_key}")
         except Exception as e:
-            # Log ranking failure
-            if self.log_callback and self.session_id:
-                self.log_callback(self.session_id, "recommendation_stage2", {
-                    "stage": "LLM Ranking Failed",
-                    "error": str(e),
-                    "fallback_count": min(5, len(candidates))
-                })
-            
-            print(f"LLM ranking error: {e}")
-            # Fallback: return first 5 candidates
-            return candidates[:5]
+            print(f"Ranking cache lookup error: {e}")
+        if cached is not None:
+            ranking_result = serialization.loads(cached)
+            self._remember_ranking(cache_key, ranking_result)
+            return ranking_result
+        return None
+    
+    def _store_ranking(self, cache_key: str, ranking_result: Dict[str, Any]):
+        """Store a successful ranking result in the in-process cache and Redis or the disk cache"""
+        if not self.ranking_cache_config.get('enabled'):
+            return
+        
+        self._remember_ranking(cache_key, ranking_result)
+        ttl_seconds = self.ranking_cache_config['ttl_seconds']
+        try:
+            if self._redis is not None:
+                self._redis.set(f"rank:{cache_key}", serialization.dumps(ranking_result), ex=ttl_seconds)
+            elif self._get_disk_cache() is not None:
+                self._disk_cache.set(f"rank:{cache_key}", serialization.dumps(ranking_result), expire=ttl_seconds)
+        except Exception as e:
+            print(f"Ranking cache store error: {e}")
+    
+    def _remember_ranking(self, cache_key: str, ranking_result: Dict[str, Any]):
+        """Insert into the in-process LRU, evicting the least recently used entry"""
+        with self._ranking_cache_lock:
+            self._ranking_cache[cache_key] = ranking_result
+            self._ranking_cache.move_to_end(cache_key)
+            if len(self._ranking_cache) > self.ranking_cache_config['max_entries']:
+                self._ranking_cache.popitem(last=False)
+    
+    def _semantic_bucket(self, candidates: List[Product], context: Dict[str, Any]) -> str:
+        """Exact part of a semantic lookup: result format, candidate id set and budget"""
+        payload = {
+            "format": [RANKING_FORMAT_VERSION, self.include_reasoning],
+            "ids": sorted(product.id for product in candidates),
+            "price_range": context.get('product_info', {}).get('price_range', {})
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+    
+    def _lookup_similar_ranking(self, candidates: List[Product],
+                                context: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str], Any]:
+        """
+        Ranking cached for the same candidates and budget under a similar query and
+        preferences. Returns (result or None, bucket, embedding) so a miss can be
+        stored after the LLM call without embedding twice.
+        """
+        if self.semantic_rank_cache is None:
+            return None, None, None
+        
+        text = context.get('original_query', '') + " " + serialization.dumps(context.get('attributes', {}), sort_keys=True)
+        try:
+            response = self.client.embeddings.create(
+                model=self.ranking_cache_config['embedding_model'],
+                input=text
+            )
+        except Exception as e:
+            print(f"Ranking cache embedding error: {e}")
+            return None, None, None
+        
+        embedding = SemanticCache.normalize(response.data[0].embedding)
+        bucket = self._semantic_bucket(candidates, context)
+        return self.semantic_rank_cache.lookup(bucket, embedding), bucket, embedding
+    
+    @staticmethod
+    def _trim_history(history: List[str], char_budget: int = HISTORY_CHAR_BUDGET) -> str:
+        """Most recent history lines whose joined length fits the budget, oldest first"""
+        kept = []
+        used = 0
+        for line in reversed(history):
+            used += len(line) + len(HISTORY_SEPARATOR) * bool(kept)
+            if used > char_budget:
+                if not kept:
+                    # A single over-long latest turn still contributes its ending
+                    kept.append(line[-char_budget:])
+                break
+            kept.append(line)
+        return HISTORY_SEPARATOR.join(reversed(kept))
     
     def _build_ranking_prompt(self, candidates: List[Product], context: Dict[str, Any]) -> str:
-        """Build the ranking prompt for LLM"""
+        """Build the per-request ranking prompt (the rubric is in the system prompt)"""
         
         # Extract context information
         original_query = context.get('original_query', 'fashion item')
@@ -134,128 +647,165 @@ class LLMRanker:
         price_info = context.get('product_info', {}).get('price_range', {})
         conversation_history = context.get('conversation_history', [])
         
-        # Format conversation history
-        history_text = "\n".join(conversation_history[-4:]) if conversation_history else "None"
+        # Format conversation history (most recent turns within the character budget)
+        history_text = self._trim_history(conversation_history) or "None"
         
         # Format price information
-        price_text = "No specific budget mentioned"
+        price_text = "none"
         if price_info:
             min_p = price_info.get('min_price')
             max_p = price_info.get('max_price')
             if max_p:
-                price_text = f"Budget: up to ${max_p}"
+                price_text = f"up to ${max_p}"
             elif min_p:
-                price_text = f"Budget: at least ${min_p}"
-        
-        # Format candidate products
-        candidates_text = ""
-        for i, product in enumerate(candidates, 1):
-            candidates_text += f"{i}. **{product.name}** - ${product.price}\n"
-            candidates_text += f"   Category: {product.category} | Fit: {product.fit} | Color: {product.color_or_print}\n"
-            if product.fabric:
-                candidates_text += f"   Fabric: {product.fabric}"
-            if product.occasion:
-                candidates_text += f" | Occasion: {product.occasion}"
-            if product.neckline:
-                candidates_text += f" | Neckline: {product.neckline}"
-            candidates_text += f"\n   Sizes: {', '.join(product.available_sizes)}\n\n"
-        
-        prompt = f"""You are an expert fashion stylist helping a customer find the perfect items. 
-
-USER CONTEXT:
-- Original Request: "{original_query}"
-- Stated Preferences: {json.dumps(attributes, indent=2)}
-- {price_text}
-- Recent Conversation: {history_text}
-
-CANDIDATE PRODUCTS:
-{candidates_text}
-
-TASK: Select the TOP 5 products that best match this customer's needs. Consider:
-
-RANKING CRITERIA:
-1. **Relevance (40%)**: How well does the product match their stated preferences?
-2. **Style Coherence (25%)**: Does it fit the overall vibe/occasion they mentioned?
-3. **Value (20%)**: Is it appropriately priced for what they're looking for?
-4. **Variety (15%)**: Ensure the final 5 offer good options diversity
-
-RESPONSE FORMAT (JSON only):
-{{
-  "top_5": [
-    {{
-      "product_number": 1,
-      "product_name": "Product Name",
-      "ranking_score": 95,
-      "reasoning": "Brief explanation of why this is perfect for them"
-    }},
-    ...
-  ],
-  "overall_reasoning": "Brief explanation of the selection strategy"
-}}
-
-Respond with JSON only:"""
+                price_text = f"at least ${min_p}"
         
-        return prompt
+        # Candidate lines are rendered once per product at catalog load
+        return RANKING_PROMPT_TEMPLATE.format(
+            query=original_query,
+            attributes=serialization.dumps(attributes),
+            budget=price_text,
+            history=history_text,
+            candidates="\n".join(product.prompt_line for product in candidates)
+        )
     
-    def _call_llm_for_ranking(self, prompt: str) -> Dict[str, Any]:
-        """Call LLM to get ranking decision"""
-        
-        response = self.client.chat.completions.create(
-            model=self.config['openai']['model'],
+    def _ranking_request(self, prompt: str, model: Optional[str] = None) -> Dict[str, Any]:
+        """Chat completion arguments for a ranking prompt"""
+        return dict(
+            model=model or self.config['openai']['model'],
             messages=[
-                {"role": "system", "content": "You are a helpful fashion stylist assistant that responds with valid JSON only."},
+                {"role": "system", "content": self.system_prompt},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,  # Lower temperature for more consistent ranking
-            max_tokens=800,
-            timeout=self.config['openai']['timeout_seconds']
+            # ~15 tokens per id/score entry; reasoning roughly doubles that
+            max_tokens=800 if self.include_reasoning else 500,
+            stop=["\n\n\n"],  # Guard against runaway whitespace padding
+            timeout=self.config['openai']['timeout_seconds'],
+            response_format=self.response_format
         )
+    
+    def _call_llm_for_ranking(self, prompt: str, model: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Call LLM to get ranking decision. The whole rankings array is read and sorted
+        by score; the model's order is not relied on.
+        """
+        response = self.client.chat.completions.create(**self._ranking_request(prompt, model))
         
-        response_text = response.choices[0].message.content.strip()
+        # Structured output guarantees schema-conforming JSON (no code fences)
+        return serialization.loads(response.choices[0].message.content)
+    
+    async def _call_llm_for_ranking_async(self, prompt: str, model: Optional[str] = None) -> Dict[str, Any]:
+        """Async LLM ranking call, limited to max_concurrency in flight per ranker"""
+        async with self._llm_semaphore:
+            response = await self.aclient.chat.completions.create(**self._ranking_request(prompt, model))
+        return serialization.loads(response.choices[0].message.content)
+    
+    def submit_ranking_batch(self, jobs: List[Tuple[List[Product], Dict[str, Any]]]) -> str:
+        """
+        Submit many rankings as one OpenAI Batch API job (half the token price, no
+        per-minute limits; results within 24h). For offline work such as nightly
+        precomputation or evaluation runs, not for live sessions.
         
-        # Clean up response if needed
-        if response_text.startswith('```json'):
-            response_text = response_text[7:-3]
-        elif response_text.startswith('```'):
-            response_text = response_text[3:-3]
+        Each job is (candidates, conversation_context); its custom_id is the
+        context's session_id, or job-{index}. Returns the batch id.
+        """
+        pending = {}
+        lines = []
+        for index, (candidates, context) in enumerate(jobs):
+            custom_id = context.get('session_id') or f"job-{index}"
+            if custom_id in pending:
+                raise ValueError(f"Duplicate batch job id: {custom_id}")
+            pending[custom_id] = (candidates, context)
+            
+            body = self._ranking_request(self._build_ranking_prompt(candidates, context),
+                                         self._ranking_model(candidates, context))
+            body.pop('timeout')  # client option, not part of the request body
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
         
-        # Parse JSON response
-        ranking_result = json.loads(response_text)
+        with tempfile.NamedTemporaryFile("w+b", suffix=".jsonl") as f:
+            f.write("\n".join(lines).encode())
+            f.seek(0)
+            input_file = self.client.files.create(file=f, purpose="batch")
         
-        return ranking_result
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        self._batch_jobs[batch.id] = pending
+        print(f"Submitted ranking batch {batch.id} with {len(pending)} jobs")
+        return batch.id
     
-    def _parse_ranking_result(self, ranking_result: Dict[str, Any], candidates: List[Product]) -> List[Product]:
-        """Parse LLM ranking result and return ordered products"""
+    def collect_ranking_batch(self, batch_id: str,
+                              jobs: Optional[Dict[str, Tuple[List[Product], Dict[str, Any]]]] = None
+                              ) -> Optional[Dict[str, List[Product]]]:
+        """
+        Top 5 products per custom_id once the batch has completed (None while it is
+        still running). jobs maps custom_id to (candidates, context) and defaults to
+        what this ranker submitted. Failed jobs fall back to their first 5 candidates.
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            print(f"Ranking batch {batch_id} is {batch.status}")
+            return None
+        
+        jobs = jobs if jobs is not None else self._batch_jobs.get(batch_id, {})
+        results = {custom_id: candidates[:5] for custom_id, (candidates, _) in jobs.items()}
+        if batch.output_file_id is None:
+            return results
+        
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            job = jobs.get(record['custom_id'])
+            response = record.get('response') or {}
+            if job is None or response.get('status_code') != 200:
+                continue
+            
+            candidates, context = job
+            ranking_result = json.loads(response['body']['choices'][0]['message']['content'])
+            self._store_ranking(self._ranking_cache_key(candidates, context), ranking_result)
+            results[record['custom_id']] = self._parse_ranking_result(ranking_result, candidates)
+        
+        self._batch_jobs.pop(batch_id, None)
+        return results
+    
+    def _parse_ranking_result(self, ranking_result: Dict[str, Any], candidates: List[Product],
+                              limit: int = 5) -> List[Product]:
+        """Parse LLM ranking result and return the top `limit` products in order"""
         
         ranked_products = []
         
         try:
-            top_5 = ranking_result.get('top_5', [])
-            
-            for item in top_5:
-                product_number = item.get('product_number', 1)
-                # Convert to 0-based index
-                index = product_number - 1
-                
-                if 0 <= index < len(candidates):
-                    product = candidates[index]
-                    # Add ranking metadata to product (optional)
-                    if hasattr(product, '__dict__'):
-                        product.ranking_score = item.get('ranking_score', 0)
-                        product.ranking_reasoning = item.get('reasoning', '')
-                    ranked_products.append(product)
+            candidates_by_id = {product.id: product for product in candidates}
             
-            # If we don't have 5 products, fill with remaining candidates
-            used_indices = set()
-            for item in top_5:
-                used_indices.add(item.get('product_number', 1) - 1)
+            # Apply scores by id, best first; unknown or repeated ids are ignored.
+            # Only the products actually returned are copied with their ranking.
+            rankings = sorted(ranking_result.get('rankings', []), key=lambda item: item.get('score', 0), reverse=True)
+            for item in rankings:
+                if len(ranked_products) == limit:
+                    break
+                product = candidates_by_id.pop(item.get('id'), None)
+                if product is None:
+                    continue
+                # Ranked copy; catalog products are shared and immutable
+                ranked_products.append(product.with_ranking(float(item.get('score', 0)), item.get('reasoning', '')))
             
-            for i, candidate in enumerate(candidates):
-                if i not in used_indices and len(ranked_products) < 5:
-                    ranked_products.append(candidate)
+            # If the ranking skipped candidates, fill up with the rest in candidate order
+            for product in candidates_by_id.values():
+                if len(ranked_products) == limit:
+                    break
+                ranked_products.append(product)
             
             return ranked_products
             
         except Exception as e:
             print(f"Error parsing ranking result: {e}")
-            return candidates[:5]
+            return candidates[:limit]
@@ -1,17 +1,44 @@
 """
 Data models for the recommendation engine
 """
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+import numpy as np
 
+if TYPE_CHECKING:
+    from .catalog import CatalogArrays
 
-@dataclass
+# Bit positions of the canonical sizes in Product.size_mask (at most 8, so the
+# catalog column fits in uint8); other sizes are matched against available_sizes directly
+SIZE_BITS = {"XS": 0, "S": 1, "M": 2, "L": 3, "XL": 4, "XXL": 5, "XXXL": 6}
+
+
+def size_mask_for(sizes: Iterable[str]) -> int:
+    """Bitmask of the canonical sizes in a size list"""
+    mask = 0
+    for size in sizes:
+        bit = SIZE_BITS.get(size.upper())
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+# Column order of Product.prompt_line
+PROMPT_LINE_COLUMNS = "id|name|price|category|fit|color|fabric|occasion|neckline|sizes"
+
+
+@dataclass(slots=True, frozen=True)
 class Product:
-    """Product data model matching the Excel structure"""
+    """
+    Product data model matching the Excel structure.
+    
+    Catalog products are shared by every session, so they are immutable; ranking
+    returns copies carrying ranking_score/ranking_reasoning (see with_ranking).
+    """
     id: str
     name: str
     category: str
-    available_sizes: List[str]
+    available_sizes: Tuple[str, ...]
     fit: Optional[str]
     fabric: Optional[str]
     sleeve_length: Optional[str]
@@ -21,9 +48,34 @@ class Product:
     length: Optional[str]
     pant_type: Optional[str]
     price: float
+    ranking_score: Optional[float] = field(default=None, compare=False)
+    ranking_reasoning: Optional[str] = field(default=None, compare=False)
+    size_mask: int = field(default=0, init=False, repr=False, compare=False)
+    prompt_line: str = field(default="", init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        # Derived fields of a frozen instance are set once, bypassing __setattr__
+        object.__setattr__(self, 'available_sizes', tuple(self.available_sizes))
+        object.__setattr__(self, 'size_mask', size_mask_for(self.available_sizes))
+        object.__setattr__(self, 'prompt_line', self.render_prompt_line())
+    
+    def with_ranking(self, score: float, reasoning: str = '') -> 'Product':
+        """Copy of this product carrying a ranking score and reasoning"""
+        return replace(self, ranking_score=score, ranking_reasoning=reasoning)
+    
+    def render_prompt_line(self) -> str:
+        """Compact pipe-delimited description used in ranking prompts (see PROMPT_LINE_COLUMNS)"""
+        return "|".join([
+            self.id, self.name, str(self.price), self.category,
+            self.fit or "", self.color_or_print or "", self.fabric or "",
+            self.occasion or "", self.neckline or "", ",".join(self.available_sizes)
+        ])
     
     def matches_size(self, size: str) -> bool:
         """Check if product is available in the given size"""
+        bit = SIZE_BITS.get(size.upper())
+        if bit is not None:
+            return bool(self.size_mask & (1 << bit))
         return size in self.available_sizes
     
     def matches_price_range(self, min_price: float = None, max_price: float = None) -> bool:
@@ -41,6 +93,10 @@ class AttributeFilter:
     name: str
     values: List[str]
     confidence: float
+    
+    def catalog_mask(self, arrays: 'CatalogArrays') -> np.ndarray:
+        """Catalog rows whose attribute matches any of the values"""
+        return arrays.attribute_mask(self.name, self.values)
 
 
 @dataclass
@@ -50,3 +106,7 @@ class PriceFilter:
     max_price: Optional[float]
     confidence: float
     name: str = "price"  # Add name attribute for consistency
+    
+    def catalog_mask(self, arrays: 'CatalogArrays') -> np.ndarray:
+        """Catalog rows within the price range"""
+        return arrays.price_mask(self.min_price, self.max_price)
@@ -1,10 +1,14 @@
 """
 Progressive confidence-based product matching
 """
+import logging
 import traceback
-from typing import List, Dict, Any, Union
+from typing import Any, Callable, Dict, List, Optional, Union
+import numpy as np
 from .models import Product, AttributeFilter, PriceFilter
-from .catalog import ProductCatalog
+from .catalog import FILTERABLE_ATTRIBUTES, ProductCatalog
+
+logger = logging.getLogger(__name__)
 
 
 class ProgressiveMatcher:
@@ -19,25 +23,29 @@ class ProgressiveMatcher:
         self.log_callback = None
         self.session_id = None
     
-    def find_recommendations(self, conversation_attributes: Dict[str, Any]) -> List[Product]:
+    def find_recommendations(self, conversation_attributes: Dict[str, Any],
+                             log_callback: Optional[Callable] = None,
+                             session_id: Optional[str] = None) -> List[Product]:
         """
         Main method: Find product recommendations using progressive filtering
         
         Args:
             conversation_attributes: Output from conversation system with attributes,
                                    confidence_scores, and product_info
+            log_callback, session_id: Where this call's logs go (default: the
+                                      matcher's own log_callback/session_id)
         
         Returns:
             List of recommended products
         """
-        print(f"Finding recommendations for: {conversation_attributes}")
+        logger.debug("Finding recommendations for: %s", conversation_attributes)
         
         # Step 1: Prepare filters using Strategy 3 (confidence threshold)
         filters = self.prepare_filters(conversation_attributes)
-        print(f"Prepared {len(filters)} filters")
+        logger.debug("Prepared %d filters", len(filters))
         
         # Step 2: Apply Strategy 4 (progressive removal)
-        recommendations = self.apply_progressive_filtering(filters)
+        recommendations = self.apply_progressive_filtering(filters, log_callback, session_id)
         
         return recommendations
     
@@ -47,54 +55,41 @@ class ProgressiveMatcher:
         """
         filters = []
         
-        print(f"DEBUG: prepare_filters called with attributes: {attributes}")
-        
         try:
             # Process attribute filters
             attributes_dict = attributes.get('attributes', {})
-            print(f"DEBUG: attributes_dict: {attributes_dict}")
+            confidence_scores_dict = attributes.get('confidence_scores', {})
             
             for attr_name, values in attributes_dict.items():
+                # A filter on something products don't have would match nothing
+                if attr_name not in FILTERABLE_ATTRIBUTES:
+                    logger.warning("Ignoring filter on unknown product attribute %r", attr_name)
+                    continue
+                
+                confidences = None
                 try:
-                    print(f"DEBUG: Processing attribute '{attr_name}' with values: {values} (type: {type(values)})")
-                    
                     # Check if values is actually a list
                     if not isinstance(values, list):
-                        print(f"ERROR: values for {attr_name} is not a list! Type: {type(values)}, Value: {values}")
-                        # Convert to list if it's not
+                        logger.warning("Values for %s are not a list (%s); wrapping them", attr_name, type(values).__name__)
                         values = [values] if values is not None else []
-                        print(f"DEBUG: Converted to list: {values}")
                     
                     # Get confidence scores
-                    confidence_scores_dict = attributes.get('confidence_scores', {})
-                    print(f"DEBUG: confidence_scores_dict: {confidence_scores_dict}")
-                    
                     confidences = confidence_scores_dict.get(attr_name, [1.0] * len(values))
-                    print(f"DEBUG: confidences for {attr_name}: {confidences} (type: {type(confidences)})")
                     
                     # Apply confidence threshold
-                    filtered_values = []
-                    filtered_confidences = []
-                    
-                    for value, conf in zip(values, confidences):
-                        print(f"DEBUG: Processing value '{value}' with confidence {conf}")
-                        if conf >= self.confidence_threshold:
-                            filtered_values.append(value)
-                            filtered_confidences.append(conf)
+                    conf_array = np.asarray(confidences, dtype=np.float64)
+                    passing = conf_array >= self.confidence_threshold
+                    filtered_values = [value for value, kept in zip(values, passing) if kept]
+                    filtered_confidences = conf_array[passing][:len(filtered_values)]
                     
                     # Fallback if nothing meets threshold
                     if not filtered_values:
-                        print(f"DEBUG: No values met threshold, using highest confidence")
-                        max_idx = confidences.index(max(confidences))
+                        max_idx = int(conf_array.argmax())
                         filtered_values = [values[max_idx]]
-                        filtered_confidences = [confidences[max_idx]]
-                    
-                    print(f"DEBUG: Final filtered_values: {filtered_values}")
-                    print(f"DEBUG: Final filtered_confidences: {filtered_confidences}")
+                        filtered_confidences = conf_array[max_idx:max_idx + 1]
                     
                     # Create filter with average confidence
-                    avg_confidence = sum(filtered_confidences) / len(filtered_confidences)
-                    print(f"DEBUG: Creating AttributeFilter for {attr_name}")
+                    avg_confidence = float(filtered_confidences.mean())
                     
                     filter_obj = AttributeFilter(
                         name=attr_name,
@@ -103,242 +98,190 @@ class ProgressiveMatcher:
                     )
                     filters.append(filter_obj)
                     
-                    print(f"Filter {attr_name}: {filtered_values} (confidence: {avg_confidence:.2f})")
-                    
-                except Exception as e:
-                    print(f"ERROR: Processing attribute {attr_name}: {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
-                    print(f"ERROR: values: {values}, confidences: {confidences}")
+                    logger.debug("Filter %s: %s (confidence: %.2f)", attr_name, filtered_values, avg_confidence)
+                
+                except Exception:
+                    logger.exception("Error processing attribute %s (values: %s, confidences: %s)",
+                                     attr_name, values, confidences)
             
             # Add price filter
-            print(f"DEBUG: Processing price filter")
             price_info = attributes.get('product_info', {}).get('price_range')
-            print(f"DEBUG: price_info: {price_info}")
             
             if price_info:
                 try:
-                    print(f"DEBUG: Creating PriceFilter")
                     price_filter = PriceFilter(
                         min_price=price_info.get('min_price'),
                         max_price=price_info.get('max_price'),
                         confidence=price_info.get('confidence', 1.0)
                     )
                     filters.append(price_filter)
-                    print(f"Price filter: ${price_info.get('min_price', 0)}-${price_info.get('max_price', '∞')} (confidence: {price_info.get('confidence', 1.0):.2f})")
-                except Exception as e:
-                    print(f"ERROR: Creating price filter: {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
+                    logger.debug("Price filter: $%s-$%s (confidence: %.2f)", price_info.get('min_price', 0),
+                                 price_info.get('max_price', '∞'), price_info.get('confidence', 1.0))
+                except Exception:
+                    logger.exception("Error creating price filter from %s", price_info)
             
-            print(f"DEBUG: prepare_filters completed successfully with {len(filters)} filters")
             return filters
-            
-        except Exception as e:
-            print(f"ERROR: Fatal error in prepare_filters: {e}")
-            print(f"ERROR: Full traceback:")
-            print(traceback.format_exc())
+        
+        except Exception:
+            logger.exception("Fatal error in prepare_filters")
             return []
     
-    def apply_progressive_filtering(self, filters: List[Union[AttributeFilter, PriceFilter]]) -> List[Product]:
+    def _stage1_logger(self, log_callback: Optional[Callable],
+                       session_id: Optional[str]) -> Callable[[Dict[str, Any]], None]:
+        """Stage 1 log sink for one filtering run; callback errors are logged, never raised"""
+        log_callback = log_callback or self.log_callback
+        session_id = session_id or self.session_id
+        
+        def log(details: Dict[str, Any]):
+            if log_callback and session_id:
+                try:
+                    log_callback(session_id, "recommendation_stage1", details)
+                except Exception:
+                    logger.exception("Logging callback failed")
+        return log
+    
+    def apply_progressive_filtering(self, filters: List[Union[AttributeFilter, PriceFilter]],
+                                    log_callback: Optional[Callable] = None,
+                                    session_id: Optional[str] = None) -> List[Product]:
         """
         Strategy 4: Progressive filter removal based on confidence
         """
-        print(f"DEBUG: apply_progressive_filtering called with {len(filters)} filters")
-        
+        log = self._stage1_logger(log_callback, session_id)
         try:
-            # Debug each filter before sorting
-            for i, f in enumerate(filters):
-                print(f"DEBUG: Filter {i}: {f.name} (confidence: {f.confidence}, type: {type(f)})")
-                print(f"DEBUG: Filter {i} values: {getattr(f, 'values', 'N/A')}")
-            
-            print(f"DEBUG: About to sort filters by confidence")
             # Sort filters by confidence (lowest first for removal)
             sorted_filters = sorted(filters, key=lambda f: f.confidence)
-            print(f"DEBUG: Filters sorted successfully")
-            
-            print(f"DEBUG: About to copy sorted filters")
-            active_filters = sorted_filters.copy()
-            print(f"DEBUG: Filters copied successfully, active_filters count: {len(active_filters)}")
             
             # Log initial filter setup
-            if self.log_callback and self.session_id:
-                try:
-                    print(f"DEBUG: About to create filter_names list")
-                    filter_names = [f.name for f in active_filters]
-                    print(f"DEBUG: filter_names created: {filter_names}")
-                    
-                    self.log_callback(self.session_id, "recommendation_stage1", {
-                        "filters_applied": len(active_filters),
-                        "filter_names": filter_names,
-                        "target_count": self.target_count
-                    })
-                    print(f"DEBUG: Logging callback completed")
-                except Exception as e:
-                    print(f"ERROR: Logging callback failed: {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
+            log({
+                "filters_applied": len(sorted_filters),
+                "filter_names": [f.name for f in sorted_filters],
+                "target_count": self.target_count
+            })
+            
+            # A catalog no larger than the target is returned whole whatever the filters:
+            # relaxation only stops early when every product already matches
+            if len(self.catalog.products) <= self.target_count:
+                log({
+                    "stage": "Progressive Filtering Skipped",
+                    "reason": "catalog is not larger than the target count",
+                    "final_candidates": len(self.catalog.products)
+                })
+                return list(self.catalog.products)
+            
+            logger.debug("Starting progressive filtering with %d filters", len(sorted_filters))
             
-            print(f"Starting progressive filtering with {len(active_filters)} filters")
+            # Filters are only ever relaxed from the front, so the rows matching each
+            # remaining suffix of filters can be intersected once up front
+            suffix_masks = self.suffix_masks(sorted_filters)
             
+            # Filters sorted_filters[cursor:] are active; relaxing one advances the cursor
+            cursor = 0
             relaxation_steps = []
             
             while True:
                 try:
-                    print(f"DEBUG: About to apply filters, active_filters count: {len(active_filters)}")
-                    # Apply current filters
-                    results = self.apply_filters(active_filters)
-                    print(f"DEBUG: apply_filters completed, results count: {len(results)}")
+                    # Rows passing the current filters; products are only materialized
+                    # for the step that returns
+                    mask = suffix_masks[cursor]
+                    active_count = len(sorted_filters) - cursor
+                    found = int(np.count_nonzero(mask))
                     
                     # Log current filtering results
-                    if self.log_callback and self.session_id:
-                        try:
-                            self.log_callback(self.session_id, "recommendation_stage1", {
-                                "active_filters": len(active_filters),
-                                "candidates_found": len(results),
-                                "target_reached": len(results) >= self.target_count
-                            })
-                        except Exception as e:
-                            print(f"ERROR: Logging callback failed: {e}")
+                    log({
+                        "active_filters": active_count,
+                        "candidates_found": found,
+                        "target_reached": found >= self.target_count
+                    })
                     
-                    print(f"With {len(active_filters)} filters: {len(results)} products found")
+                    logger.debug("With %d filters: %d products found", active_count, found)
                     
                     # Check if we have enough results
-                    if len(results) >= self.target_count:
+                    if found >= self.target_count:
+                        results = self.catalog.products_from_mask(mask, limit=self.target_count)
                         # Log successful completion
-                        if self.log_callback and self.session_id:
-                            try:
-                                self.log_callback(self.session_id, "recommendation_stage1", {
-                                    "stage": "Progressive Filtering Complete",
-                                    "final_candidates": len(results),
-                                    "relaxation_steps": relaxation_steps,
-                                    "filters_remaining": len(active_filters)
-                                })
-                            except Exception as e:
-                                print(f"ERROR: Logging callback failed: {e}")
+                        log({
+                            "stage": "Progressive Filtering Complete",
+                            "final_candidates": found,
+                            "relaxation_steps": relaxation_steps,
+                            "filters_remaining": active_count
+                        })
                         
-                        print(f"Target reached! Returning {len(results[:self.target_count])} products")
-                        return results[:self.target_count]
+                        logger.debug("Target reached! Returning %d products", len(results))
+                        return results
                     
                     # If no more filters to remove, return what we have
-                    if not active_filters:
+                    if not active_count:
+                        results = self.catalog.products_from_mask(mask)
                         # Log completion with insufficient results
-                        if self.log_callback and self.session_id:
-                            try:
-                                self.log_callback(self.session_id, "recommendation_stage1", {
-                                    "stage": "Progressive Filtering Complete (Insufficient Results)",
-                                    "final_candidates": len(results),
-                                    "relaxation_steps": relaxation_steps,
-                                    "all_filters_relaxed": True
-                                })
-                            except Exception as e:
-                                print(f"ERROR: Logging callback failed: {e}")
+                        log({
+                            "stage": "Progressive Filtering Complete (Insufficient Results)",
+                            "final_candidates": len(results),
+                            "relaxation_steps": relaxation_steps,
+                            "all_filters_relaxed": True
+                        })
                         
-                        print(f"No more filters to remove. Returning {len(results)} products")
+                        logger.debug("No more filters to remove. Returning %d products", len(results))
                         return results
                     
-                    print(f"DEBUG: About to remove lowest confidence filter")
                     # Remove lowest confidence filter
-                    removed = active_filters.pop(0)
-                    print(f"DEBUG: Removed filter: {removed.name}")
+                    removed = sorted_filters[cursor]
+                    cursor += 1
                     
                     relaxation_step = f"{removed.name} (confidence: {removed.confidence:.2f})"
                     relaxation_steps.append(relaxation_step)
                     
                     # Log relaxation step
-                    if self.log_callback and self.session_id:
-                        try:
-                            self.log_callback(self.session_id, "recommendation_stage1", {
-                                "relaxed_filter": removed.name,
-                                "filter_confidence": removed.confidence,
-                                "remaining_filters": len(active_filters)
-                            })
-                        except Exception as e:
-                            print(f"ERROR: Logging callback failed: {e}")
-                    
-                    print(f"Relaxing filter: {relaxation_step}")
+                    log({
+                        "relaxed_filter": removed.name,
+                        "filter_confidence": removed.confidence,
+                        "remaining_filters": len(sorted_filters) - cursor
+                    })
                     
-                except Exception as e:
-                    print(f"ERROR: Error in progressive filtering loop: {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
-                    print(f"ERROR: active_filters count: {len(active_filters)}")
-                    print(f"ERROR: active_filters: {[f.name for f in active_filters]}")
+                    logger.debug("Relaxing filter: %s", relaxation_step)
+                
+                except Exception:
+                    logger.exception("Error in progressive filtering loop (active filters: %s)",
+                                     [f.name for f in sorted_filters[cursor:]])
                     return []
-            
-        except Exception as e:
-            print(f"ERROR: Fatal error in apply_progressive_filtering: {e}")
-            print(f"ERROR: Full traceback:")
-            print(traceback.format_exc())
-            print(f"ERROR: filters count: {len(filters)}")
-            print(f"ERROR: filters: {[f.name for f in filters]}")
+        
+        except Exception:
+            logger.exception("Fatal error in apply_progressive_filtering (filters: %s)",
+                             [f.name for f in filters])
             return []
         
         # Fallback (should never reach here)
-        print("Fallback: returning first products from catalog")
+        logger.warning("Fallback: returning first products from catalog")
         return self.catalog.products[:self.target_count]
     
+    def filter_mask(self, filter_obj: Union[AttributeFilter, PriceFilter]) -> np.ndarray:
+        """Catalog rows passing a single filter (each filter type computes its own mask)"""
+        return filter_obj.catalog_mask(self.catalog.arrays)
+    
+    def suffix_masks(self, filters: List[Union[AttributeFilter, PriceFilter]]) -> List[np.ndarray]:
+        """masks[i] = rows passing every filter in filters[i:] (masks[-1] keeps all rows)"""
+        masks = [np.ones(len(self.catalog.products), dtype=bool)]
+        for filter_obj in reversed(filters):
+            masks.append(masks[-1] & self.filter_mask(filter_obj))
+        return masks[::-1]
+    
     def apply_filters(self, active_filters: List[Union[AttributeFilter, PriceFilter]]) -> List[Product]:
         """Apply all active filters to the product catalog"""
-        results = self.catalog.products.copy()
-        
-        for filter_obj in active_filters:
-            if isinstance(filter_obj, AttributeFilter):
-                results = self.apply_attribute_filter(results, filter_obj)
-            elif isinstance(filter_obj, PriceFilter):
-                results = self.apply_price_filter(results, filter_obj)
-        
-        return results
+        # Intersect boolean masks over the catalog's column view; only survivors
+        # are materialized as Product objects
+        return self.catalog.products_from_mask(self.suffix_masks(active_filters)[0])
     
     def apply_attribute_filter(self, products: List[Product], filter_obj: AttributeFilter) -> List[Product]:
         """Apply OR logic within attribute values"""
-        matching = []
-        
-        print(f"DEBUG: Applying filter '{filter_obj.name}' with values {filter_obj.values}")
-        print(f"DEBUG: Processing {len(products)} products")
-        
         try:
-            for i, product in enumerate(products):
-                try:
-                    print(f"DEBUG: Processing product {i}: {product.name}")
-                    
-                    # Special handling for sizes attribute
-                    if filter_obj.name == 'sizes':
-                        print(f"DEBUG: Sizes filter - product.available_sizes: {product.available_sizes} (type: {type(product.available_sizes)})")
-                        
-                        # Check if any of the user's desired sizes are available in the product
-                        # Ensure product.available_sizes is a list
-                        available_sizes = product.available_sizes if isinstance(product.available_sizes, list) else []
-                        print(f"DEBUG: Converted available_sizes: {available_sizes}")
-                        
-                        if any(size in available_sizes for size in filter_obj.values):
-                            print(f"DEBUG: Product {product.name} matches size filter")
-                            matching.append(product)
-                        else:
-                            print(f"DEBUG: Product {product.name} does not match size filter")
-                    else:
-                        product_value = getattr(product, filter_obj.name, None)
-                        print(f"DEBUG: Product {product.name} - {filter_obj.name}: {product_value}")
-                        
-                        # OR logic: product matches if its value is in any of the filter values
-                        if product_value and product_value in filter_obj.values:
-                            print(f"DEBUG: Product {product.name} matches {filter_obj.name} filter")
-                            matching.append(product)
-                        else:
-                            print(f"DEBUG: Product {product.name} does not match {filter_obj.name} filter")
-                            
-                except Exception as e:
-                    print(f"ERROR: Processing product {i} ({product.name}): {e}")
-                    print(f"ERROR: Full traceback:")
-                    print(traceback.format_exc())
-                    print(f"ERROR: Product data: {vars(product)}")
-                    
+            # Look the products' rows up in the catalog's inverted index instead of
+            # inspecting each product
+            mask = filter_obj.catalog_mask(self.catalog.arrays)
+            keep = mask[self.catalog.rows_of(products)]
+            matching = [product for product, kept in zip(products, keep) if kept]
+        
         except Exception as e:
-            print(f"ERROR: Fatal error in apply_attribute_filter for {filter_obj.name}: {e}")
-            print(f"ERROR: Full traceback:")
-            print(traceback.format_exc())
-            print(f"ERROR: Filter values: {filter_obj.values}")
-            print(f"ERROR: Products count: {len(products)}")
+            logger.exception("Filter application failed for %s (values: %s, %d products)",
+                             filter_obj.name, filter_obj.values, len(products))
             
             # Log the error if callback is available
             if self.log_callback and self.session_id:
@@ -350,18 +293,12 @@ class ProgressiveMatcher:
                 })
             return []
         
-        print(f"DEBUG: Filter '{filter_obj.name}' matched {len(matching)} products")
+        logger.debug("Filter '%s' matched %d products", filter_obj.name, len(matching))
         return matching
     
     def apply_price_filter(self, products: List[Product], filter_obj: PriceFilter) -> List[Product]:
         """Apply price range filter"""
-        matching = []
-        
-        for product in products:
-            if filter_obj.min_price and product.price < filter_obj.min_price:
-                continue
-            if filter_obj.max_price and product.price > filter_obj.max_price:
-                continue
-            matching.append(product)
-        
-        return matching
+        # One vectorized comparison over the catalog's price column, indexed by the products' rows
+        mask = filter_obj.catalog_mask(self.catalog.arrays)
+        keep = mask[self.catalog.rows_of(products)]
+        return [product for product, kept in zip(products, keep) if kept]
@@ -0,0 +1,106 @@
+"""
+Session storage for the Vibe Shopping API
+
+Conversation states and debug logs live in Redis when REDIS_URL is set, so any
+worker can serve any session and idle sessions expire after SESSION_TTL_SECONDS.
+Without Redis they are kept in process memory (single-worker development).
+"""
+import os
+import pickle
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from conversation_flow import ConversationState
+
+try:
+    import redis.asyncio as redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Idle sessions (and their logs) expire after this many seconds in Redis
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', '3600'))
+
+# Most recent debug log lines kept per session; older lines are dropped
+MAX_LOGS_PER_SESSION = 500
+
+
+class InMemorySessionStore:
+    """Process-local session storage (no expiry, not shared between workers)"""
+
+    def __init__(self):
+        self.sessions: Dict[str, ConversationState] = {}
+        self.logs: Dict[str, Deque[str]] = {}
+
+    async def get(self, session_id: str) -> Optional[ConversationState]:
+        return self.sessions.get(session_id)
+
+    async def save(self, state: ConversationState):
+        self.sessions[state.session_id] = state
+
+    async def delete(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self.logs.pop(session_id, None)
+
+    async def list_ids(self) -> List[str]:
+        return list(self.sessions.keys())
+
+    async def append_logs(self, session_id: str, lines: List[str]):
+        logs = self.logs.get(session_id)
+        if logs is None:
+            logs = self.logs[session_id] = deque(maxlen=MAX_LOGS_PER_SESSION)
+        logs.extend(lines)
+
+    async def get_logs(self, session_id: str) -> List[str]:
+        return list(self.logs.get(session_id, []))
+
+
+class RedisSessionStore:
+    """Redis-backed session storage: pickled states under session:{id}, logs in a list"""
+
+    def __init__(self, url: str, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.client = redis.Redis.from_url(url, decode_responses=False)
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def _state_key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    @staticmethod
+    def _logs_key(session_id: str) -> str:
+        return f"session_logs:{session_id}"
+
+    async def get(self, session_id: str) -> Optional[ConversationState]:
+        blob = await self.client.get(self._state_key(session_id))
+        return pickle.loads(blob) if blob is not None else None
+
+    async def save(self, state: ConversationState):
+        blob = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        await self.client.set(self._state_key(state.session_id), blob, ex=self.ttl_seconds)
+
+    async def delete(self, session_id: str):
+        await self.client.delete(self._state_key(session_id), self._logs_key(session_id))
+
+    async def list_ids(self) -> List[str]:
+        prefix = len(self._state_key(""))
+        return [key.decode()[prefix:] async for key in self.client.scan_iter(match=self._state_key("*"))]
+
+    async def append_logs(self, session_id: str, lines: List[str]):
+        key = self._logs_key(session_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, *lines)
+            pipe.ltrim(key, -MAX_LOGS_PER_SESSION, -1)
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def get_logs(self, session_id: str) -> List[str]:
+        return [line.decode() for line in await self.client.lrange(self._logs_key(session_id), 0, -1)]
+
+
+def create_session_store():
+    """Redis store when REDIS_URL is configured, in-memory otherwise"""
+    url = os.getenv('REDIS_URL')
+    if url and REDIS_AVAILABLE:
+        return RedisSessionStore(url)
+    if url:
+        print("⚠️ REDIS_URL is set but the redis package is not installed; using in-memory sessions")
+    return InMemorySessionStore()
@@ -2,12 +2,18 @@
 Enhanced data models for the Vibe-to-Attribute Mapping Engine with Pydantic support
 """
 from dataclasses import dataclass, field
-from typing import Dict, List, Any, Optional, Type
-from pydantic import BaseModel, Field, validator
+from types import MappingProxyType
+from typing import ClassVar, Dict, FrozenSet, List, Any, Mapping, Optional, Sequence, Tuple, Type
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 from enum import Enum
+import functools
 import json
+import os
+import re
+import numpy as np
+from common import serialization
 try:
-    from fuzzywuzzy import fuzz
+    from rapidfuzz import fuzz, process
     FUZZY_AVAILABLE = True
 except ImportError:
     FUZZY_AVAILABLE = False
@@ -15,6 +21,12 @@ except ImportError:
 
 
 
+def tokenize_query(query: str) -> Tuple[str, Tuple[str, ...]]:
+    """Lowercased query and its words for VibeRule.matches_query (very short words like "i" dropped)"""
+    query_lower = query.lower()
+    return query_lower, tuple(word for word in query_lower.split() if len(word) >= 2)
+
+
 @dataclass
 class VibeRule:
     """Simple fashion domain rule for vibe-to-attribute mapping"""
@@ -23,61 +35,89 @@ class VibeRule:
     confidence_boost: float
     reasoning: str
     
-    def matches_query(self, query: str) -> float:
-        """Calculate how well this rule matches a query using fuzzy matching"""
+    # Lowercased keywords long enough for fuzzy matching (shorter ones cause false matches)
+    _keywords_lower: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    # Target values per attribute as sets, for membership checks while merging rule output
+    target_attribute_sets: Dict[str, FrozenSet[Any]] = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self._keywords_lower = tuple(k.lower() for k in self.vibe_keywords if len(k) >= 3)
+        self.target_attribute_sets = {
+            attr_name: frozenset(values if isinstance(values, list) else [values])
+            for attr_name, values in self.target_attributes.items()
+        }
+    
+    def matches_query(self, query_lower: str, query_words: Tuple[str, ...]) -> float:
+        """
+        Calculate how well this rule matches a query using fuzzy matching.
+        Takes the output of tokenize_query, computed once per query for all rules.
+        """
         if not FUZZY_AVAILABLE:
-            # Fallback to exact matching if fuzzywuzzy not available
-            query_lower = query.lower()
+            # Fallback to exact matching if rapidfuzz not available
             matches = 0
             for keyword in self.vibe_keywords:
                 if keyword.lower() in query_lower:
                     matches += 1
             return matches / len(self.vibe_keywords) if self.vibe_keywords else 0.0
         
-        query_lower = query.lower()
-        matches = 0
-        threshold = 80  # Increased threshold to reduce false positives
+        if not self._keywords_lower:
+            return 0.0
         
-        for keyword in self.vibe_keywords:
-            keyword_lower = keyword.lower()
-            
-            # Skip very short keywords to avoid false matches
-            if len(keyword_lower) < 3:
-                continue
-            
-            # Try fuzzy matching against the whole query
-            whole_query_score = fuzz.partial_ratio(keyword_lower, query_lower)
-            
-            # Try fuzzy matching against individual words in the query
-            word_scores = []
-            for word in query_lower.split():
-                # Skip very short words to avoid false matches like "i"
-                if len(word) < 2:
-                    continue
-                    
-                # Only use ratio for word-to-word matching to avoid substring issues
-                ratio_score = fuzz.ratio(keyword_lower, word)
-                
-                # For partial matching, require minimum overlap
-                if len(word) >= 3 and len(keyword_lower) >= 3:
-                    partial_score = fuzz.partial_ratio(keyword_lower, word)
-                    # Only use partial score if it's significantly higher than ratio
-                    if partial_score > ratio_score + 20:
-                        word_scores.append(partial_score)
-                    else:
-                        word_scores.append(ratio_score)
-                else:
-                    word_scores.append(ratio_score)
-            
-            best_word_score = max(word_scores) if word_scores else 0
-            
-            # Use the better of whole query or word matching (remove reverse matching)
-            best_score = max(whole_query_score, best_word_score)
-            
-            if best_score >= threshold:
-                matches += best_score / 100.0  # Convert to 0-1 scale
+        matches = float(keyword_match_scores(self._keywords_lower, query_lower, query_words).sum())
+        return matches / len(self.vibe_keywords)
+
+
+# Minimum fuzzy score (0-100) for a keyword to count as matched; high to reduce false positives
+KEYWORD_MATCH_THRESHOLD = 80
+
+
+def keyword_match_scores(keywords: Sequence[str], query_lower: str, query_words: Tuple[str, ...]) -> np.ndarray:
+    """
+    Per-keyword match in 0-1 (0 below KEYWORD_MATCH_THRESHOLD): the best fuzzy score
+    against the whole query or one of its words, all keywords scored in a few cdist calls
+    """
+    def scores(scorer, choices: Sequence[str]) -> np.ndarray:
+        # Rounded to integer percentages like fuzzywuzzy's scores
+        return np.rint(process.cdist(keywords, choices, scorer=scorer))
+    
+    # Fuzzy matching of every keyword against the whole query
+    best_scores = scores(fuzz.partial_ratio, [query_lower])[:, 0]
+    
+    # Fuzzy matching against individual words. Word-to-word matching uses ratio to
+    # avoid substring issues; partial_ratio is only used for words of 3+ characters
+    # when it is significantly higher.
+    if query_words:
+        ratio_scores = scores(fuzz.ratio, query_words)
+        partial_scores = scores(fuzz.partial_ratio, query_words)
+        use_partial = np.array([len(word) >= 3 for word in query_words]) & (partial_scores > ratio_scores + 20)
+        word_scores = np.where(use_partial, partial_scores, ratio_scores)
+        best_scores = np.maximum(best_scores, word_scores.max(axis=1))
+    
+    # Convert passing scores to 0-1 scale
+    return np.where(best_scores >= KEYWORD_MATCH_THRESHOLD, best_scores / 100.0, 0.0)
+
+
+class VibeRuleIndex:
+    """
+    Fuzzy keywords of many rules in one list, so a query is scored against every
+    rule with the same few cdist calls instead of a set per rule
+    """
+    
+    def __init__(self, rules: List[VibeRule]):
+        self.rules = rules
+        self._keywords = [keyword for rule in rules for keyword in rule._keywords_lower]
+        # Rule position of each keyword, and each rule's divisor (all of its keywords)
+        self._owners = np.repeat(np.arange(len(rules)), [len(rule._keywords_lower) for rule in rules])
+        self._keyword_counts = np.array([max(len(rule.vibe_keywords), 1) for rule in rules], dtype=np.float64)
+    
+    def match_scores(self, query_lower: str, query_words: Tuple[str, ...]) -> np.ndarray:
+        """VibeRule.matches_query for every rule, in rule order"""
+        if not FUZZY_AVAILABLE or not self._keywords:
+            return np.array([rule.matches_query(query_lower, query_words) for rule in self.rules])
         
-        return matches / len(self.vibe_keywords) if self.vibe_keywords else 0.0
+        keyword_scores = keyword_match_scores(self._keywords, query_lower, query_words)
+        matches = np.bincount(self._owners, weights=keyword_scores, minlength=len(self.rules))
+        return matches / self._keyword_counts
 
 
 
@@ -92,9 +132,7 @@ class AttributeSchema:
     @classmethod
     def from_file(cls, file_path: str) -> 'AttributeSchema':
         """Load schema from JSON file"""
-        with open(file_path, 'r') as f:
-            schema_dict = json.load(f)
-        return cls(schema_dict)
+        return cls(serialization.load_file(file_path))
     
     def get_all_attributes(self) -> Dict[str, List[str]]:
         """Get all attribute categories and their possible values"""
@@ -125,10 +163,28 @@ class MappingResult:
 # PYDANTIC MODELS FOR OPENAI STRUCTURED OUTPUT
 # ============================================================================
 
-def create_enum_from_schema(attribute_name: str, schema_path: str = "data/attribute_schema.json") -> Type[Enum]:
-    """Dynamically create enum from attribute schema"""
-    with open(schema_path, 'r') as f:
-        schema = json.load(f)
+@functools.lru_cache(maxsize=4)
+def _read_schema(abs_path: str) -> Tuple[Dict[str, List[str]], Dict[str, FrozenSet[str]]]:
+    schema = serialization.load_file(abs_path)
+    return schema, {name: frozenset(values) for name, values in schema.items()}
+
+
+def load_attribute_schema(schema_path: str = "data/attribute_schema.json") -> Tuple[Dict[str, List[str]], Dict[str, FrozenSet[str]]]:
+    """
+    Attribute schema and a set of valid values per attribute, read once per path.
+    The returned objects are shared; do not modify them.
+    """
+    return _read_schema(os.path.abspath(schema_path))
+
+
+# Runs of characters that cannot appear in an enum member name (underscores included, so they collapse)
+_ENUM_NAME_SEPARATORS = re.compile(r"[\W_]+")
+_DROPPED_ENUM_NAME_CHARS = str.maketrans("", "", "()")
+
+
+@functools.lru_cache(maxsize=None)
+def _create_enum(attribute_name: str, abs_path: str) -> Type[Enum]:
+    schema, _ = _read_schema(abs_path)
     
     values = schema.get(attribute_name, [])
     
@@ -136,21 +192,21 @@ def create_enum_from_schema(attribute_name: str, schema_path: str = "data/attrib
     enum_dict = {}
     for value in values:
         # Convert to valid enum name (e.g., "Body hugging" -> "BODY_HUGGING")
-        enum_name = value.upper().replace(" ", "_").replace("-", "_").replace("/", "_").replace("(", "").replace(")", "")
-        # Handle special characters and ensure valid Python identifier
-        enum_name = "".join(c if c.isalnum() or c == "_" else "_" for c in enum_name)
-        # Remove multiple underscores
-        while "__" in enum_name:
-            enum_name = enum_name.replace("__", "_")
-        enum_name = enum_name.strip("_")
-        
+        enum_name = _ENUM_NAME_SEPARATORS.sub("_", value.upper().translate(_DROPPED_ENUM_NAME_CHARS)).strip("_")
         enum_dict[enum_name] = value
     
     return Enum(f"{attribute_name.title()}Type", enum_dict)
 
 
+def create_enum_from_schema(attribute_name: str, schema_path: str = "data/attribute_schema.json") -> Type[Enum]:
+    """Dynamically create enum from attribute schema (one enum class per attribute and resolved path)"""
+    return _create_enum(attribute_name, os.path.abspath(schema_path))
+
+
 class AttributeValue(BaseModel):
     """Individual attribute value with confidence"""
+    model_config = ConfigDict(extra='ignore', validate_assignment=False)
+    
     value: str = Field(description="The attribute value")
     confidence: float = Field(ge=0.0, le=1.0, description="Confidence in this specific value (0.0-1.0)")
     
@@ -158,30 +214,39 @@ class AttributeValue(BaseModel):
     def validate_against_schema(cls, attribute_name: str, value: str, schema_path: str = "data/attribute_schema.json") -> bool:
         """Validate that value exists in schema for given attribute"""
         try:
-            with open(schema_path, 'r') as f:
-                schema = json.load(f)
-            return value in schema.get(attribute_name, [])
+            _, valid_values = load_attribute_schema(schema_path)
+            return value in valid_values.get(attribute_name, ())
         except (FileNotFoundError, json.JSONDecodeError):
             return False
 
 
 class PriceRange(BaseModel):
     """Price range preferences with validation"""
+    model_config = ConfigDict(extra='ignore', validate_assignment=False)
+    
     min_price: Optional[float] = Field(default=None, ge=0, description="Minimum price preference in USD")
     max_price: Optional[float] = Field(default=None, ge=0, description="Maximum price preference in USD")
     confidence: float = Field(ge=0.0, le=1.0, description="Confidence in price range extraction (0.0-1.0)")
     
-    @validator('max_price')
-    def max_greater_than_min(cls, v, values):
+    @model_validator(mode='after')
+    def max_greater_than_min(self) -> 'PriceRange':
         """Ensure max_price is greater than min_price when both are provided"""
-        if v is not None and values.get('min_price') is not None:
-            if v < values['min_price']:
+        if self.max_price is not None and self.min_price is not None:
+            if self.max_price < self.min_price:
                 raise ValueError('max_price must be greater than or equal to min_price')
-        return v
+        return self
 
 
 class AttributeExtractionResult(BaseModel):
     """Complete structured output model for OpenAI parsing with comprehensive fashion query extraction"""
+    model_config = ConfigDict(extra='ignore', validate_assignment=False)
+    
+    # Names of the attribute fields below, in declaration order (not model fields)
+    ATTRIBUTE_NAMES: ClassVar[Tuple[str, ...]] = (
+        'category', 'fit', 'fabric', 'color_or_print', 'occasion',
+        'sleeve_length', 'neckline', 'length', 'pant_type', 'sizes'
+    )
+    ATTRIBUTE_NAME_SET: ClassVar[FrozenSet[str]] = frozenset(ATTRIBUTE_NAMES)
     
     # Product identification
     product_name: Optional[str] = Field(
@@ -203,44 +268,45 @@ class AttributeExtractionResult(BaseModel):
     
     # Fashion attributes with per-value confidence
     # Each attribute can have multiple values with individual confidence scores
-    category: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    # (an empty list when nothing was extracted)
+    category: List[AttributeValue] = Field(
+        default_factory=list,
         description="Product category (top, dress, skirt, pants, etc.)"
     )
-    fit: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    fit: List[AttributeValue] = Field(
+        default_factory=list,
         description="How the item fits (Relaxed, Body hugging, Tailored, etc.)"
     )
-    fabric: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    fabric: List[AttributeValue] = Field(
+        default_factory=list,
         description="Fabric material (Linen, Silk, Cotton, etc.)"
     )
-    color_or_print: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    color_or_print: List[AttributeValue] = Field(
+        default_factory=list,
         description="Color or print pattern (Red, Floral print, etc.)"
     )
-    occasion: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    occasion: List[AttributeValue] = Field(
+        default_factory=list,
         description="Suitable occasions (Party, Work, Everyday, etc.)"
     )
-    sleeve_length: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    sleeve_length: List[AttributeValue] = Field(
+        default_factory=list,
         description="Sleeve style and length (Short sleeves, Sleeveless, etc.)"
     )
-    neckline: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    neckline: List[AttributeValue] = Field(
+        default_factory=list,
         description="Neckline style (V neck, Round neck, etc.)"
     )
-    length: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    length: List[AttributeValue] = Field(
+        default_factory=list,
         description="Garment length (Mini, Midi, Maxi, etc.)"
     )
-    pant_type: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    pant_type: List[AttributeValue] = Field(
+        default_factory=list,
         description="Pant style (Wide-legged, Skinny, etc.)"
     )
-    sizes: Optional[List[AttributeValue]] = Field(
-        default=None, 
+    sizes: List[AttributeValue] = Field(
+        default_factory=list,
         description="Size preferences (XS, S, M, L, XL, etc.)"
     )
     
@@ -262,21 +328,14 @@ class AttributeExtractionResult(BaseModel):
         description="Detailed explanation of extraction logic, confidence reasoning, and any assumptions made"
     )
     
-    def get_attribute_names(self) -> List[str]:
-        """Get list of all possible attribute names"""
-        return [
-            'category', 'fit', 'fabric', 'color_or_print', 'occasion',
-            'sleeve_length', 'neckline', 'length', 'pant_type', 'sizes'
-        ]
+    def get_attribute_names(self) -> Tuple[str, ...]:
+        """Get all possible attribute names"""
+        return self.ATTRIBUTE_NAMES
     
     def get_extracted_attributes(self) -> Dict[str, List[AttributeValue]]:
         """Get only attributes that have extracted values"""
-        result = {}
-        for attr_name in self.get_attribute_names():
-            attr_value = getattr(self, attr_name)
-            if attr_value is not None and len(attr_value) > 0:
-                result[attr_name] = attr_value
-        return result
+        # Field values live in the instance __dict__, in declaration order
+        return {name: value for name, value in self.__dict__.items() if name in self.ATTRIBUTE_NAME_SET and value}
     
     def get_high_confidence_values(self, threshold: float = 0.7) -> Dict[str, List[AttributeValue]]:
         """Get only attribute values with confidence above threshold"""
@@ -291,11 +350,15 @@ class AttributeExtractionResult(BaseModel):
         """Validate all extracted values against the attribute schema"""
         invalid_values = {}
         
+        # Fetch the cached value sets once rather than once per value
+        try:
+            _, valid_values = load_attribute_schema(schema_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            valid_values = {}
+        
         for attr_name, values in self.get_extracted_attributes().items():
-            invalid_for_attr = []
-            for attr_value in values:
-                if not AttributeValue.validate_against_schema(attr_name, attr_value.value, schema_path):
-                    invalid_for_attr.append(attr_value.value)
+            allowed = valid_values.get(attr_name, ())
+            invalid_for_attr = [attr_value.value for attr_value in values if attr_value.value not in allowed]
             
             if invalid_for_attr:
                 invalid_values[attr_name] = invalid_for_attr
@@ -303,41 +366,66 @@ class AttributeExtractionResult(BaseModel):
         return invalid_values
 
 
+@dataclass(frozen=True, slots=True)
+class SchemaRegistry:
+    """Fully built attribute schema: valid values and enum per attribute, read-only once created"""
+    schema_path: str
+    schema: Mapping[str, List[str]]
+    values_by_attr: Mapping[str, FrozenSet[str]]
+    enum_by_attr: Mapping[str, Type[Enum]]
+    
+    @classmethod
+    def load(cls, schema_path: str = "data/attribute_schema.json") -> 'SchemaRegistry':
+        """Build the registry, including every attribute's enum"""
+        schema, value_sets = load_attribute_schema(schema_path)
+        return cls(
+            schema_path=schema_path,
+            schema=MappingProxyType(schema),
+            values_by_attr=MappingProxyType(value_sets),
+            enum_by_attr=MappingProxyType({name: create_enum_from_schema(name, schema_path) for name in schema})
+        )
+
+
 class AttributeSchemaManager:
     """Manages dynamic loading and validation of attribute schema"""
     
     def __init__(self, schema_path: str = "data/attribute_schema.json"):
         self.schema_path = schema_path
-        self._schema_cache = None
-        self._enum_cache = {}
+        self._registry: Optional[SchemaRegistry] = None
+    
+    @property
+    def registry(self) -> SchemaRegistry:
+        """Schema values and enums, all built on first access"""
+        if self._registry is None:
+            self._registry = SchemaRegistry.load(self.schema_path)
+        return self._registry
     
-    def load_schema(self) -> Dict[str, List[str]]:
-        """Load schema from JSON file with caching"""
-        if self._schema_cache is None:
-            with open(self.schema_path, 'r') as f:
-                self._schema_cache = json.load(f)
-        return self._schema_cache
+    def load_schema(self) -> Mapping[str, List[str]]:
+        """Load schema from JSON file with caching (read-only view)"""
+        return self.registry.schema
     
     def get_attribute_values(self, attribute_name: str) -> List[str]:
         """Get possible values for a specific attribute"""
-        schema = self.load_schema()
-        return schema.get(attribute_name, [])
+        return self.registry.schema.get(attribute_name, [])
     
     def get_attribute_enum(self, attribute_name: str) -> Type[Enum]:
-        """Get or create enum for attribute with caching"""
-        if attribute_name not in self._enum_cache:
-            self._enum_cache[attribute_name] = create_enum_from_schema(attribute_name, self.schema_path)
-        return self._enum_cache[attribute_name]
+        """Get the enum for an attribute (attributes outside the schema get an empty enum)"""
+        enum_type = self.registry.enum_by_attr.get(attribute_name)
+        if enum_type is None:
+            enum_type = create_enum_from_schema(attribute_name, self.schema_path)
+        return enum_type
     
     def validate_value(self, attribute_name: str, value: str) -> bool:
         """Validate that a value is valid for the given attribute"""
-        return value in self.get_attribute_values(attribute_name)
+        return value in self.registry.values_by_attr.get(attribute_name, ())
     
     def get_all_attribute_names(self) -> List[str]:
         """Get list of all attribute names in schema"""
-        schema = self.load_schema()
-        return list(schema.keys())
+        return list(self.registry.schema.keys())
 
 
-# Global schema manager instance
+# Global schema manager instance, built at import when the default schema is reachable
+# (the path is relative to the working directory; otherwise it is built on first use)
 schema_manager = AttributeSchemaManager()
+if os.path.exists(schema_manager.schema_path):
+    schema_manager.load_schema()
@@ -7,26 +7,65 @@ Contains three core components:
 3. VibeToAttributeMapper - Main orchestrator combining LLM + Rules
 """
 
-import json
+import asyncio
+import hashlib
 import os
-from typing import Dict, List, Any, Optional
-import openai
+import sys
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+from common import serialization
+from common.config import load_config
 from .models import (
     MappingResult, 
     AttributeExtractionResult,
     AttributeValue,
     PriceRange,
     VibeRule, 
-    AttributeSchema
+    AttributeSchema,
+    VibeRuleIndex,
+    tokenize_query
 )
 
 
+# Confidence markers for test_query output: low (<0.6), medium (0.6-0.8), high (>=0.8)
+CONFIDENCE_EMOJI = ("🔴", "🟡", "🟢")
+
+TEST_QUERY_LEGEND = """
+🔤 LEGEND:
+  🤖 LLM extracted  📋 Rule added  🔄 LLM + Rule enhanced
+  🟢 High confidence (>0.8)  🟡 Medium (0.6-0.8)  🔴 Low (<0.6)"""
+
+
+def confidence_emoji_for(confidence: float) -> str:
+    return CONFIDENCE_EMOJI[(confidence >= 0.6) + (confidence >= 0.8)]
+
+
+# Extraction results remembered per extractor, by model and normalized query
+EXTRACTION_CACHE_SIZE = 1024
+
+
 class LLMExtractor:
     """Handles OpenAI API integration for attribute extraction using structured output"""
     
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], schema: Optional[AttributeSchema] = None):
         self.config = config
-        self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # The SDK is imported here, so rule-only users of this module never load it
+        import openai
+        from common.clients import get_async_openai, get_openai
+        self._openai = openai
+        # Process-wide clients, sharing the pooled connections of every other OpenAI caller
+        self.client = get_openai()
+        self.aclient = get_async_openai()
+        
+        # LRU of serialized extractions; callers modify results, so each hit is a fresh copy
+        self._extraction_cache: "OrderedDict[str, str]" = OrderedDict()
+        
+        # The schema never changes after loading, so its prompt block is serialized once
+        # (compact JSON: same content for the model, fewer input tokens)
+        self._schema: Optional[AttributeSchema] = None
+        self._schema_prompt_block = ""
+        if schema is not None:
+            self._schema_block_for(schema)
         
         # Simplified prompt focusing on extraction logic since structure is enforced
         self.system_prompt = """You are a fashion expert AI that extracts structured attributes from natural language fashion queries.
@@ -51,57 +90,129 @@ PRICE EXTRACTION:
 For each extracted attribute value, provide individual confidence scores.
 Mark attributes as 'explicit' if directly mentioned, 'inferred' if derived from context."""
 
-    def extract_attributes(self, query: str, schema: AttributeSchema) -> Optional[AttributeExtractionResult]:
-        """Extract attributes from query using OpenAI structured output"""
-        try:
-            # Create user prompt with schema context
-            user_prompt = f"""
+    def _schema_block_for(self, schema: AttributeSchema) -> str:
+        """Serialized schema for the prompt, recomputed only when a different schema is passed"""
+        if schema is not self._schema:
+            self._schema = schema
+            self._schema_prompt_block = serialization.dumps(schema.get_all_attributes())
+        return self._schema_prompt_block
+    
+    def _extraction_request(self, query: str, schema: AttributeSchema) -> Dict[str, Any]:
+        """Arguments of the structured-output extraction call"""
+        # Create user prompt with schema context
+        user_prompt = f"""
 AVAILABLE ATTRIBUTE VALUES:
-{json.dumps(schema.get_all_attributes(), indent=2)}
+{self._schema_block_for(schema)}
 
 USER QUERY: "{query}"
 
 Extract fashion attributes, price preferences, and product details from this query.
 Provide confidence scores for each extracted value and explain your reasoning.
 """
-            
+        return dict(
+            model=self.config['openai']['model'],
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            response_format=AttributeExtractionResult,
+            temperature=self.config['openai']['temperature'],
+            max_tokens=self.config['openai']['max_tokens'],
+            timeout=self.config['openai']['timeout_seconds']
+        )
+    
+    def _cache_key(self, query: str) -> str:
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha1(f"{self.config['openai']['model']}\n{normalized}".encode()).hexdigest()
+    
+    def _cached_extraction(self, cache_key: str) -> Optional[AttributeExtractionResult]:
+        blob = self._extraction_cache.get(cache_key)
+        if blob is None:
+            return None
+        self._extraction_cache.move_to_end(cache_key)
+        return AttributeExtractionResult.model_validate_json(blob)
+    
+    def _remember_extraction(self, cache_key: str, extraction: Optional[AttributeExtractionResult]):
+        """Insert a successful extraction into the LRU (failures are retried next time)"""
+        if extraction is None:
+            return
+        self._extraction_cache[cache_key] = extraction.model_dump_json()
+        self._extraction_cache.move_to_end(cache_key)
+        if len(self._extraction_cache) > EXTRACTION_CACHE_SIZE:
+            self._extraction_cache.popitem(last=False)
+    
+    def extract_attributes(self, query: str, schema: AttributeSchema) -> Optional[AttributeExtractionResult]:
+        """Extract attributes from query using OpenAI structured output (cached per normalized query)"""
+        cache_key = self._cache_key(query)
+        extraction = self._cached_extraction(cache_key)
+        if extraction is None:
+            extraction = self._request_extraction(query, schema)
+            self._remember_extraction(cache_key, extraction)
+        return extraction
+    
+    async def extract_attributes_async(self, query: str, schema: AttributeSchema) -> Optional[AttributeExtractionResult]:
+        """Async extract_attributes, so extractions for many queries can overlap"""
+        cache_key = self._cache_key(query)
+        extraction = self._cached_extraction(cache_key)
+        if extraction is None:
+            extraction = await self._request_extraction_async(query, schema)
+            self._remember_extraction(cache_key, extraction)
+        return extraction
+    
+    def _request_extraction(self, query: str, schema: AttributeSchema) -> Optional[AttributeExtractionResult]:
+        try:
             # Call OpenAI API with structured output using beta client
-            response = self.client.beta.chat.completions.parse(
-                model=self.config['openai']['model'],
-                messages=[
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                response_format=AttributeExtractionResult,
-                temperature=self.config['openai']['temperature'],
-                max_tokens=self.config['openai']['max_tokens'],
-                timeout=self.config['openai']['timeout_seconds']
-            )
+            response = self.client.beta.chat.completions.parse(**self._extraction_request(query, schema))
             
             # Get the parsed result directly from OpenAI
-            if response.choices[0].message.parsed:
-                return response.choices[0].message.parsed
-            else:
-                return None
+            return response.choices[0].message.parsed or None
             
-        except openai.APITimeoutError:
+        except self._openai.APITimeoutError:
             return None
-        except openai.APIError:
+        except self._openai.APIError:
+            return None
+        except Exception:
+            return None
+    
+    async def _request_extraction_async(self, query: str, schema: AttributeSchema) -> Optional[AttributeExtractionResult]:
+        try:
+            response = await self.aclient.beta.chat.completions.parse(**self._extraction_request(query, schema))
+            return response.choices[0].message.parsed or None
+            
+        except self._openai.APITimeoutError:
+            return None
+        except self._openai.APIError:
             return None
         except Exception:
             return None
 
 
+# Built rules per absolute rules-file path, with the file's mtime when they were built
+_RULES_CACHE: Dict[str, Tuple[float, Dict[str, List[VibeRule]]]] = {}
+
+
 class RuleEnhancer:
     """Applies fashion domain rules to enhance and validate LLM output"""
     
     def __init__(self, rules_file_path: str):
         self.rules = self._load_rules(rules_file_path)
+        # Keywords of all rules, scored together for each query
+        self._rule_index = VibeRuleIndex([rule for rules in self.rules.values() for rule in rules])
     
     def _load_rules(self, file_path: str) -> Dict[str, List[VibeRule]]:
-        """Load vibe rules from JSON file"""
-        with open(file_path, 'r') as f:
-            rules_data = json.load(f)
+        """Load vibe rules from JSON file (built once per file version and shared; do not modify)"""
+        abs_path = os.path.abspath(file_path)
+        mtime = os.path.getmtime(abs_path)
+        cached = _RULES_CACHE.get(abs_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        
+        rules = self._build_rules(abs_path)
+        _RULES_CACHE[abs_path] = (mtime, rules)
+        return rules
+    
+    def _build_rules(self, file_path: str) -> Dict[str, List[VibeRule]]:
+        rules_data = serialization.load_file(file_path)
         
         organized_rules = {}
         
@@ -120,9 +231,10 @@ class RuleEnhancer:
                     else:
                         keywords.append(attr_values.lower())
                 
+                # Target values are always lists, so merging needs no type checks
                 vibe_rule = VibeRule(
                     vibe_keywords=keywords,
-                    target_attributes={k: v for k, v in rule_data.items() 
+                    target_attributes={k: v if isinstance(v, list) else [v] for k, v in rule_data.items() 
                                      if k not in ['confidence_boost', 'reasoning']},
                     confidence_boost=rule_data.get('confidence_boost', 0.5),
                     reasoning=rule_data.get('reasoning', f"Rule match for {rule_name}")
@@ -131,39 +243,37 @@ class RuleEnhancer:
         
         return organized_rules
     
-    def enhance_attributes(self, query: str, llm_attributes: Dict[str, Any]) -> tuple[Dict[str, Any], List[VibeRule]]:
-        """Enhance LLM attributes with rule-based matching"""
-        enhanced_attributes = llm_attributes.copy()
+    def enhance_attributes(self, query: str, llm_attributes: Dict[str, List[str]]) -> tuple[Dict[str, List[str]], List[VibeRule]]:
+        """Enhance LLM attributes (lists of values per attribute) with rule-based matching"""
+        enhanced_attributes = dict(llm_attributes)
         applied_rules = []
+        # Values already present per attribute, so merging many rule values stays linear
+        seen_values: Dict[str, set] = {}
         
-        query_lower = query.lower()
+        # Lowercase and split the query once for all rules
+        query_lower, query_words = tokenize_query(query)
         
-        # Apply rules from all categories
-        for category, rules in self.rules.items():
-            for rule in rules:
-                match_score = rule.matches_query(query)
+        # Apply rules from all categories (scored in one pass, in category order)
+        match_scores = self._rule_index.match_scores(query_lower, query_words)
+        for rule, match_score in zip(self._rule_index.rules, match_scores):
+            # Apply rule if it matches
+            if match_score > 0:
+                applied_rules.append(rule)
                 
-                # Apply rule if it matches
-                if match_score > 0:
-                    applied_rules.append(rule)
+                # Merge rule attributes
+                for attr_name, attr_values in rule.target_attributes.items():
+                    seen = seen_values.get(attr_name)
+                    if seen is None:
+                        # First rule touching this attribute: copy the LLM's list so the
+                        # caller's stays unchanged
+                        merged = enhanced_attributes[attr_name] = list(llm_attributes.get(attr_name, ()))
+                        seen = seen_values[attr_name] = set(merged)
                     
-                    # Merge rule attributes
-                    for attr_name, attr_values in rule.target_attributes.items():
-                        if attr_name not in enhanced_attributes:
-                            enhanced_attributes[attr_name] = []
-                        
-                        # Ensure we have a list
-                        if not isinstance(enhanced_attributes[attr_name], list):
-                            enhanced_attributes[attr_name] = [enhanced_attributes[attr_name]]
-                        
-                        # Add new values
-                        if isinstance(attr_values, list):
-                            for value in attr_values:
-                                if value not in enhanced_attributes[attr_name]:
-                                    enhanced_attributes[attr_name].append(value)
-                        else:
-                            if attr_values not in enhanced_attributes[attr_name]:
-                                enhanced_attributes[attr_name].append(attr_values)
+                    # Add new values
+                    for value in attr_values:
+                        if value not in seen:
+                            seen.add(value)
+                            enhanced_attributes[attr_name].append(value)
         
         return enhanced_attributes, applied_rules
 
@@ -175,17 +285,42 @@ class VibeToAttributeMapper:
                  schema_file: str = "data/attribute_schema.json",
                  rules_file: str = "data/vibe_rules.json"):
         
-        # Load configuration
-        with open(config_file, 'r') as f:
-            self.config = json.load(f)
+        # Load configuration (parsed once per path and shared)
+        self.config = load_config(config_file)
         
         # Initialize components
         self.schema = AttributeSchema.from_file(schema_file)
-        self.llm_extractor = LLMExtractor(self.config)
+        self.llm_extractor = LLMExtractor(self.config, self.schema)
         self.rule_enhancer = RuleEnhancer(rules_file)
     
-    def map_vibe_to_attributes(self, query: str) -> MappingResult:
-        """Main method to convert vibe query to structured attributes"""
+    def map_vibe_to_attributes(self, query: str,
+                               llm_extraction: Optional[AttributeExtractionResult] = None) -> MappingResult:
+        """
+        Main method to convert vibe query to structured attributes
+
+        Args:
+            query: Natural language fashion query
+            llm_extraction: Extraction already produced by a caller's own LLM request;
+                            when given, the extraction call is skipped
+        """
+        # Stage 1: LLM Extraction with Pydantic structured output
+        if llm_extraction is None:
+            llm_extraction = self.llm_extractor.extract_attributes(query, self.schema)
+        return self._map_extraction(query, llm_extraction)
+    
+    async def map_vibe_to_attributes_async(self, query: str,
+                                           llm_extraction: Optional[AttributeExtractionResult] = None) -> MappingResult:
+        """Async map_vibe_to_attributes: only the extraction call is awaited, rule work runs inline"""
+        if llm_extraction is None:
+            llm_extraction = await self.llm_extractor.extract_attributes_async(query, self.schema)
+        return self._map_extraction(query, llm_extraction)
+    
+    async def map_batch(self, queries: List[str]) -> List[MappingResult]:
+        """Map several queries with their extraction calls running concurrently"""
+        return list(await asyncio.gather(*(self.map_vibe_to_attributes_async(query) for query in queries)))
+    
+    def _map_extraction(self, query: str, llm_extraction: Optional[AttributeExtractionResult]) -> MappingResult:
+        """Stage 2 of the mapping: combine the LLM extraction (None if it failed) with the rules"""
         result = MappingResult(
             original_query=query,
             final_attributes={},
@@ -194,17 +329,16 @@ class VibeToAttributeMapper:
         
         result.add_log(f"Processing query: '{query}'")
         
-        # Stage 1: LLM Extraction with Pydantic structured output
-        llm_extraction = self.llm_extractor.extract_attributes(query, self.schema)
-        
         if llm_extraction:
             result.add_log("LLM extraction successful")
             result.llm_extraction = llm_extraction
             
+            # Read the attribute fields once; the lists below are the model's own
+            extracted = {name: getattr(llm_extraction, name) for name in llm_extraction.ATTRIBUTE_NAMES}
+            
             # Convert AttributeValue objects to simple dict for rule enhancement
             base_attributes = {}
-            for attr_name in llm_extraction.get_attribute_names():
-                attr_values = getattr(llm_extraction, attr_name)
+            for attr_name, attr_values in extracted.items():
                 if attr_values:
                     base_attributes[attr_name] = [av.value for av in attr_values]
             
@@ -212,6 +346,7 @@ class VibeToAttributeMapper:
         else:
             result.add_error("LLM extraction failed")
             result.add_log("Falling back to rule-based extraction only")
+            extracted = {}
             base_attributes = {}
             base_confidence = 0.0
         
@@ -227,43 +362,31 @@ class VibeToAttributeMapper:
             if result.llm_extraction:
                 # Boost confidence for rule-enhanced attributes
                 for rule in applied_rules:
-                    for attr_name in rule.target_attributes.keys():
-                        if hasattr(result.llm_extraction, attr_name):
-                            attr_values = getattr(result.llm_extraction, attr_name)
-                            if attr_values:
-                                for av in attr_values:
-                                    # Boost confidence for values confirmed by rules
-                                    if av.value in rule.target_attributes.get(attr_name, []):
-                                        av.confidence = min(1.0, av.confidence + rule.confidence_boost * 0.15)
+                    for attr_name, rule_values in rule.target_attribute_sets.items():
+                        for av in extracted.get(attr_name, ()):
+                            # Boost confidence for values confirmed by rules
+                            if av.value in rule_values:
+                                av.confidence = min(1.0, av.confidence + rule.confidence_boost * 0.15)
                 
                 # Add new attributes from rules as AttributeValue objects
                 for attr_name, values in enhanced_attributes.items():
-                    if not hasattr(result.llm_extraction, attr_name) or not getattr(result.llm_extraction, attr_name):
-                        if attr_name in result.llm_extraction.get_attribute_names():
-                            new_values = []
-                            for value in values:
-                                # Check if this value came from LLM or rules
-                                if attr_name in base_attributes and value in base_attributes[attr_name]:
-                                    continue  # Already handled above
-                                else:
-                                    # Find which rule added this value and use its confidence
-                                    rule_confidence = 0.6  # Default fallback
-                                    for rule in applied_rules:
-                                        if attr_name in rule.target_attributes:
-                                            rule_values = rule.target_attributes[attr_name]
-                                            if isinstance(rule_values, list) and value in rule_values:
-                                                rule_confidence = rule.confidence_boost
-                                                break
-                                            elif not isinstance(rule_values, list) and value == rule_values:
-                                                rule_confidence = rule.confidence_boost
-                                                break
-                                    
-                                    # New value from rules with rule's confidence
-                                    new_values.append(AttributeValue(value=value, confidence=rule_confidence))
+                    # Only attributes the LLM left empty, so every value here came from rules
+                    if attr_name in extracted and not extracted[attr_name]:
+                        new_values = []
+                        for value in values:
+                            # Find which rule added this value and use its confidence
+                            rule_confidence = 0.6  # Default fallback
+                            for rule in applied_rules:
+                                if value in rule.target_attribute_sets.get(attr_name, ()):
+                                    rule_confidence = rule.confidence_boost
+                                    break
                             
-                            if new_values:
-                                existing_values = getattr(result.llm_extraction, attr_name) or []
-                                setattr(result.llm_extraction, attr_name, existing_values + new_values)
+                            # New value from rules with rule's confidence (rule data is
+                            # trusted, so pydantic validation is skipped)
+                            new_values.append(AttributeValue.model_construct(value=value, confidence=rule_confidence))
+                        
+                        if new_values:
+                            setattr(result.llm_extraction, attr_name, new_values)
             
             result.final_attributes = enhanced_attributes
             result.overall_confidence = result.llm_extraction.overall_confidence if result.llm_extraction else base_confidence
@@ -278,25 +401,27 @@ class VibeToAttributeMapper:
     
     def test_query(self, query: str) -> None:
         """Test a single query with detailed before/after analysis and scoring breakdown"""
-        print(f"\n{'='*80}")
-        print(f"🔍 TESTING QUERY: '{query}'")
-        print(f"{'='*80}")
+        # The report is collected and written in one go rather than line by line
+        parts: List[str] = []
+        parts.append(f"\n{'='*80}")
+        parts.append(f"🔍 TESTING QUERY: '{query}'")
+        parts.append(f"{'='*80}")
         
         result = self.map_vibe_to_attributes(query)
         
         # Step 1: Show LLM Extraction (Before Rules)
-        print(f"\n📊 LLM EXTRACTION (Before Rules):")
+        parts.append(f"\n📊 LLM EXTRACTION (Before Rules):")
         if result.llm_extraction:
-            print(f"  🤖 Raw LLM Output:")
+            parts.append(f"  🤖 Raw LLM Output:")
             
             # Show product name and price if extracted
             if result.llm_extraction.product_name:
-                print(f"    🏷️  Product Name: {result.llm_extraction.product_name} (confidence: {result.llm_extraction.product_name_confidence:.2f})")
+                parts.append(f"    🏷️  Product Name: {result.llm_extraction.product_name} (confidence: {result.llm_extraction.product_name_confidence:.2f})")
             
             if result.llm_extraction.price_range:
                 pr = result.llm_extraction.price_range
                 price_str = f"${pr.min_price or 0}-${pr.max_price or '∞'}"
-                print(f"    💰 Price Range: {price_str} (confidence: {pr.confidence:.2f})")
+                parts.append(f"    💰 Price Range: {price_str} (confidence: {pr.confidence:.2f})")
             
             # Show original LLM attributes
             llm_attrs = {}
@@ -306,30 +431,31 @@ class VibeToAttributeMapper:
                     llm_attrs[attr_name] = attr_values
                     values_with_conf = []
                     avg_confidence = sum(av.confidence for av in attr_values) / len(attr_values)
-                    confidence_emoji = "🟢" if avg_confidence >= 0.8 else "🟡" if avg_confidence >= 0.6 else "🔴"
+                    confidence_emoji = confidence_emoji_for(avg_confidence)
                     
                     for av in attr_values:
                         values_with_conf.append(f"{av.value}({av.confidence:.2f})")
                     
-                    print(f"    {confidence_emoji} {attr_name}: {', '.join(values_with_conf)}")
+                    parts.append(f"    {confidence_emoji} {attr_name}: {', '.join(values_with_conf)}")
             
-            print(f"  🎯 LLM Confidence: {result.llm_extraction.overall_confidence:.2f}")
-            print(f"  💭 LLM Reasoning: {result.llm_extraction.reasoning}")
+            parts.append(f"  🎯 LLM Confidence: {result.llm_extraction.overall_confidence:.2f}")
+            parts.append(f"  💭 LLM Reasoning: {result.llm_extraction.reasoning}")
             
             if result.llm_extraction.explicit_attributes:
-                print(f"  🎯 Explicit Attributes: {result.llm_extraction.explicit_attributes}")
+                parts.append(f"  🎯 Explicit Attributes: {result.llm_extraction.explicit_attributes}")
             if result.llm_extraction.inferred_attributes:
-                print(f"  🔍 Inferred Attributes: {result.llm_extraction.inferred_attributes}")
+                parts.append(f"  🔍 Inferred Attributes: {result.llm_extraction.inferred_attributes}")
         else:
-            print(f"  ❌ LLM extraction failed - using rule-based extraction only")
+            parts.append(f"  ❌ LLM extraction failed - using rule-based extraction only")
         
         # Step 2: Show Rule Matching and Application
-        print(f"\n📋 RULE MATCHING:")
+        parts.append(f"\n📋 RULE MATCHING:")
         if result.rule_enhancements:
-            print(f"  ✅ Applied Rules ({len(result.rule_enhancements)} matched):")
+            parts.append(f"  ✅ Applied Rules ({len(result.rule_enhancements)} matched):")
+            query_lower, query_words = tokenize_query(query)
             for i, rule in enumerate(result.rule_enhancements, 1):
-                match_score = rule.matches_query(query)
-                print(f"    {i}. \"{rule.reasoning}\" (match: {match_score:.2f}, boost: +{rule.confidence_boost:.2f})")
+                match_score = rule.matches_query(query_lower, query_words)
+                parts.append(f"    {i}. \"{rule.reasoning}\" (match: {match_score:.2f}, boost: +{rule.confidence_boost:.2f})")
                 
                 # Show what this rule adds
                 rule_additions = []
@@ -340,13 +466,13 @@ class VibeToAttributeMapper:
                         rule_additions.append(f"{attr_name}: [{attr_values}]")
                 
                 if rule_additions:
-                    print(f"       → Adds: {', '.join(rule_additions)}")
+                    parts.append(f"       → Adds: {', '.join(rule_additions)}")
         else:
-            print(f"  ❌ No rules matched")
+            parts.append(f"  ❌ No rules matched")
         
         # Step 3: Show Final Output (After Rules)
-        print(f"\n📝 FINAL OUTPUT (After Rules):")
-        print(f"  🎯 Enhanced Attributes:")
+        parts.append(f"\n📝 FINAL OUTPUT (After Rules):")
+        parts.append(f"  🎯 Enhanced Attributes:")
         
         if result.llm_extraction:
             # Show final attributes with source indicators
@@ -355,40 +481,36 @@ class VibeToAttributeMapper:
                 rule_values = result.final_attributes.get(attr_name, [])
                 
                 if final_values or rule_values:
-                    # Determine source of each value
-                    llm_values = [av.value for av in final_values] if final_values else []
-                    all_values = set(llm_values + rule_values)
+                    # Determine source of each value; confidences are looked up by value
+                    # (reversed so the first occurrence of a repeated value wins)
+                    conf_by_value = {av.value: av.confidence for av in reversed(final_values)}
+                    rule_value_set = set(rule_values)
+                    # LLM values first, then rule additions, each once
+                    all_values = dict.fromkeys([av.value for av in final_values] + rule_values)
                     
                     value_sources = []
                     for value in all_values:
-                        if value in llm_values:
-                            # Find confidence from LLM
-                            conf = next((av.confidence for av in final_values if av.value == value), 0.0)
-                            if value in rule_values:
+                        if value in conf_by_value:
+                            # Confidence from LLM
+                            conf = conf_by_value[value]
+                            if value in rule_value_set:
                                 value_sources.append(f"{value}({conf:.2f})🔄")  # LLM + Rule enhanced
                             else:
                                 value_sources.append(f"{value}({conf:.2f})🤖")  # LLM only
                         else:
-                            # Find the actual confidence for rule-only values
-                            rule_conf = 0.60  # Default fallback
-                            if final_values:
-                                for av in final_values:
-                                    if av.value == value:
-                                        rule_conf = av.confidence
-                                        break
-                            value_sources.append(f"{value}({rule_conf:.2f})📋")  # Rule only
+                            value_sources.append(f"{value}(0.60)📋")  # Rule only (default confidence)
                     
                     if value_sources:
                         avg_conf = sum(av.confidence for av in final_values) / len(final_values) if final_values else 0.6
-                        confidence_emoji = "🟢" if avg_conf >= 0.8 else "🟡" if avg_conf >= 0.6 else "🔴"
-                        print(f"    {confidence_emoji} {attr_name}: {', '.join(value_sources)}")
+                        confidence_emoji = confidence_emoji_for(avg_conf)
+                        parts.append(f"    {confidence_emoji} {attr_name}: {', '.join(value_sources)}")
         else:
             # Fallback for rule-only extraction
             for attr, values in result.final_attributes.items():
                 if values:
-                    print(f"    📋 {attr}: {values} (rule-based)")
+                    parts.append(f"    📋 {attr}: {values} (rule-based)")
         
-        print(f"  🏆 Final Confidence: {result.overall_confidence:.2f}")
+        parts.append(f"  🏆 Final Confidence: {result.overall_confidence:.2f}")
         
         # Step 4: Show Confidence Changes
         if result.llm_extraction:
@@ -396,23 +518,23 @@ class VibeToAttributeMapper:
             final_conf = result.overall_confidence
             change = final_conf - initial_conf
             change_emoji = "↑" if change > 0 else "↓" if change < 0 else "→"
-            print(f"\n📈 CONFIDENCE CHANGES:")
-            print(f"  Overall: {initial_conf:.2f} → {final_conf:.2f} ({change_emoji}{abs(change):.2f})")
+            parts.append(f"\n📈 CONFIDENCE CHANGES:")
+            parts.append(f"  Overall: {initial_conf:.2f} → {final_conf:.2f} ({change_emoji}{abs(change):.2f})")
             
             if result.rule_enhancements:
-                print(f"  Rule Impact: +{len(result.rule_enhancements)} rules applied")
+                parts.append(f"  Rule Impact: +{len(result.rule_enhancements)} rules applied")
         
         # Step 5: Show Processing Details
         if result.errors:
-            print(f"\n❌ ERRORS:")
+            parts.append(f"\n❌ ERRORS:")
             for error in result.errors:
-                print(f"  - {error}")
+                parts.append(f"  - {error}")
         
-        print(f"\n📊 PROCESSING LOG:")
+        parts.append(f"\n📊 PROCESSING LOG:")
         for log in result.processing_log:
-            print(f"  - {log}")
+            parts.append(f"  - {log}")
+        
+        parts.append(TEST_QUERY_LEGEND)
         
-        # Legend
-        print(f"\n🔤 LEGEND:")
-        print(f"  🤖 LLM extracted  📋 Rule added  🔄 LLM + Rule enhanced")
-        print(f"  🟢 High confidence (>0.8)  🟡 Medium (0.6-0.8)  🔴 Low (<0.6)")
+        sys.stdout.write("\n".join(parts))
+        sys.stdout.write("\n")